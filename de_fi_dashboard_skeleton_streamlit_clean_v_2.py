@@ -21,16 +21,37 @@
 # - Borrow Rate (APY) per market (robuste: markets → introspection → marketByUniqueKey fallback)
 # - Optional USD recompute via DefiLlama + decimals normalization
 
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
+import logging
 import os
+import pickle
+import random
 import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from collections import OrderedDict, deque
 from datetime import datetime
-from typing import Dict, List, Any, Optional
+from urllib.parse import urlsplit
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
 import pandas as pd
 from dateutil import tz
 import streamlit as st
-from decimal import Decimal, InvalidOperation, getcontext
+from decimal import Decimal, InvalidOperation
+
+try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except Exception:  # anciennes versions de Streamlit
+    add_script_run_ctx = get_script_run_ctx = None
 
 # Optional dotenv
 try:
@@ -48,12 +69,80 @@ DEFAULT_WALLETS = [
 TIMEZONE = "Europe/Paris"
 MORPHO_GRAPHQL = "https://api.morpho.org/graphql"
 HTTP_HEADERS = {"Content-Type": "application/json", "User-Agent": "DeFiWalletMonitor/2.2"}
+DEFILLAMA_PRICES = "https://coins.llama.fi/prices/current/"
+# Longueur max d'une URL de prix, et nb de chunks récupérés en parallèle
+DEFILLAMA_MAX_URL = int(os.getenv("DEFILLAMA_MAX_URL", "2000"))
+DEFILLAMA_MAX_WORKERS = int(os.getenv("DEFILLAMA_MAX_WORKERS", "4"))
+# Cache des prix par clé: TTL, puis fenêtre où le prix périmé est servi pendant le refresh
+PRICE_TTL = int(os.getenv("PRICE_TTL", "120"))
+PRICE_STALE_MAX = int(os.getenv("PRICE_STALE_MAX", "900"))
+
+# Session HTTP partagée (keep-alive): nb d'hôtes poolés, requêtes simultanées (et connexions gardées) par hôte
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "4"))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "16"))
 
 CHAIN_OPTIONS = [1, 8453, 42161]  # Ethereum, Base, Arbitrum
 CHAIN_SLUG = {1: "ethereum", 8453: "base", 42161: "arbitrum"}
 
-# Haute précision pour les montants
-getcontext().prec = 50
+# Nb de wallets regroupés par requête marketPositions (userAddress_in)
+MORPHO_BATCH_SIZE = int(os.getenv("MORPHO_BATCH_SIZE", "25"))
+# Nb max de requêtes Morpho en parallèle
+MORPHO_MAX_WORKERS = int(os.getenv("MORPHO_MAX_WORKERS", "8"))
+# Pages marketPositions préchargées en parallèle (par requête)
+MORPHO_PAGE_WORKERS = int(os.getenv("MORPHO_PAGE_WORKERS", "4"))
+# Limiteur Morpho: débit (req/s) + rafale, plafond de requêtes en vol (AIMD),
+# et facteur de latence vs moyenne au-delà duquel on réduit la concurrence
+MORPHO_RATE_LIMIT = float(os.getenv("MORPHO_RATE_LIMIT", "10"))
+MORPHO_RATE_BURST = int(os.getenv("MORPHO_RATE_BURST", "20"))
+MORPHO_MAX_INFLIGHT = int(os.getenv("MORPHO_MAX_INFLIGHT", "16"))
+MORPHO_LATENCY_SPIKE = float(os.getenv("MORPHO_LATENCY_SPIKE", "3"))
+# Retry (requêtes idempotentes) avec backoff exponentiel + jitter, et circuit breaker par endpoint
+MORPHO_RETRIES = int(os.getenv("MORPHO_RETRIES", "3"))
+MORPHO_RETRY_BASE_DELAY = float(os.getenv("MORPHO_RETRY_BASE_DELAY", "0.25"))
+MORPHO_RETRY_MAX_DELAY = float(os.getenv("MORPHO_RETRY_MAX_DELAY", "4"))
+MORPHO_BREAKER_THRESHOLD = int(os.getenv("MORPHO_BREAKER_THRESHOLD", "5"))
+MORPHO_BREAKER_COOLDOWN = float(os.getenv("MORPHO_BREAKER_COOLDOWN", "30"))
+# Rendu progressif par défaut, et intervalle min (s) entre deux redessins provisoires
+PROGRESSIVE_RENDER = os.getenv("PROGRESSIVE_RENDER", "1") != "0"
+LIVE_REDRAW_S = float(os.getenv("LIVE_REDRAW_S", "0.3"))
+# Cache disque SQLite optionnel (survit aux redémarrages): chemin vide = désactivé
+DISK_CACHE_PATH = os.getenv("DISK_CACHE_PATH", "")
+DISK_CACHE_MAX_MB = float(os.getenv("DISK_CACHE_MAX_MB", "64"))
+DISK_CACHE_TTL = int(os.getenv("DISK_CACHE_TTL", "300"))
+# TTL des caches st.cache_data des requêtes Morpho (graphql, positions)
+QUERY_TTL = 300
+# Pré-chauffage: wallets/marchés suivis en plus de DEFAULT_WALLETS, chaînes
+PREWARM_ENABLED = os.getenv("PREWARM", "1") != "0"
+WATCHLIST_WALLETS = re.findall(r"0x[a-fA-F0-9]{40}", os.getenv("WATCHLIST_WALLETS", ""))
+WATCHLIST_MARKETS = [k for k in re.split(r"[,\s]+", os.getenv("WATCHLIST_MARKETS", "")) if k]
+PREWARM_CHAINS = [int(c) for c in re.findall(r"\d+", os.getenv("PREWARM_CHAINS", "1"))]
+# Budget (s) pour toute la collecte de données d'un rendu; 0 = pas d'échéance
+RENDER_BUDGET_S = float(os.getenv("RENDER_BUDGET_S", "20"))
+# Snapshots last-known-good servis après dépassement: LRU borné (marge au-delà des books suivis
+# pour wallet×chaînes, marchés) et âge max (s)
+SNAPSHOT_MAX_WALLETS = int(os.getenv("SNAPSHOT_MAX_WALLETS", "512"))
+SNAPSHOT_MAX_MARKETS = int(os.getenv("SNAPSHOT_MAX_MARKETS", "4096"))
+SNAPSHOT_TTL = int(os.getenv("SNAPSHOT_TTL", str(24 * 3600)))
+# Durée de vie des capacités du schéma (forme de requête borrow APY, champs introspectés)
+CAPABILITY_TTL = int(os.getenv("MORPHO_CAPABILITY_TTL", str(24 * 3600)))
+# Durée de vie du cache de borrow APY par marché
+RATE_TTL = int(os.getenv("RATE_TTL", "300"))
+# Intervalle de pré-chauffage: par défaut 80 % du plus petit TTL réchauffé (prix, taux, requêtes)
+PREWARM_INTERVAL = float(os.getenv("PREWARM_INTERVAL", "0")) or 0.8 * min(PRICE_TTL, RATE_TTL, QUERY_TTL)
+# Registre des tokens (décimales, symbole): durée de vie mémoire/disque, les décimales ne changent pas
+TOKEN_TTL = int(os.getenv("TOKEN_TTL", str(30 * 24 * 3600)))
+# Tokens absents de la réponse assets: mémorisés comme inconnus pendant cette durée (pas de re-requête)
+TOKEN_UNKNOWN_TTL = int(os.getenv("TOKEN_UNKNOWN_TTL", str(24 * 3600)))
+# Taux de borrow demandés directement dans la requête marketPositions quand le schéma le permet
+MORPHO_COMBINED_RATES = os.getenv("MORPHO_COMBINED_RATES", "1") != "0"
+
+# Onglet par wallet: nb de wallets rendus par page (seuls les wallets visibles construisent leurs widgets)
+WALLETS_PER_PAGE = int(os.getenv("WALLETS_PER_PAGE", "10"))
+
+# Plafond d'entrées des couches st.cache_data (0 = illimité)
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "0")) or None
+# Construction des lignes: "columnar" (vectorisé) ou "loop" (référence exacte, ligne par ligne)
+ROW_BUILDER = os.getenv("ROW_BUILDER", "columnar")
 
 # -----------------------------------------------------------------------------
 # Helpers
@@ -65,18 +154,537 @@ def to_local(ts_ms: int, tzname: str = TIMEZONE) -> str:
     except Exception:
         return str(ts_ms)
 
-@st.cache_data(ttl=300)
-def _run_graphql(url: str, query: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+@st.cache_resource
+def _http_session() -> requests.Session:
+    # Une session par process: connexions TCP/TLS réutilisées entre requêtes et sessions Streamlit
+    sess = requests.Session()
+    # Pas de pool_block (attente sans borne): le plafond par hôte est tenu par _host_slots
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_PER_HOST)
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
+    sess.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+    return sess
+
+@st.cache_resource
+def _host_slots(host: str) -> threading.BoundedSemaphore:
+    # HTTP_POOL_PER_HOST requêtes simultanées max par hôte, toutes sessions et threads de fond confondus
+    return threading.BoundedSemaphore(max(1, HTTP_POOL_PER_HOST))
+
+def _http_request(method: str, url: str, timeout_cap: float, **kwargs) -> requests.Response:
+    # Attente d'un créneau bornée par l'échéance du rendu (ou par timeout_cap sans échéance)
+    host = urlsplit(url).netloc
+    slots = _host_slots(host)
+    if not slots.acquire(timeout=_time_left(timeout_cap)):
+        raise DeadlineExceeded(f"no free HTTP slot for {host}")
+    try:
+        return _http_session().request(method, url, timeout=_time_left(timeout_cap), **kwargs)
+    finally:
+        slots.release()
+
+# -----------------------------------------------------------------------------
+# Observabilité des caches: hits / misses / octets / évictions / âge au hit
+# -----------------------------------------------------------------------------
+@st.cache_resource
+def _cache_stats_registry() -> Dict[str, Any]:
+    return {"lock": threading.Lock(), "caches": {}}
+
+def _cache_counters(reg: Dict[str, Any], name: str) -> Dict[str, Any]:
+    return reg["caches"].setdefault(name, {
+        "hits": 0, "misses": 0, "refreshes": 0, "evictions": 0, "bytes_stored": 0, "entries": 0,
+        "age_sum": 0.0, "age_max": 0.0, "sizes": {},
+    })
+
+def _cache_note(name: str, hits: int = 0, misses: int = 0, evictions: int = 0,
+                ages: Optional[List[float]] = None, bytes_stored: Optional[int] = None,
+                entries: Optional[int] = None) -> None:
+    reg = _cache_stats_registry()
+    with reg["lock"]:
+        c = _cache_counters(reg, name)
+        if _cache_refresh.get():
+            # Recalcul forcé du pré-chauffage: compté à part, hors hit ratio
+            c["refreshes"] += hits + misses
+            hits = misses = 0
+            ages = None
+        c["hits"] += hits
+        c["misses"] += misses
+        c["evictions"] += evictions
+        for age in ages or []:
+            c["age_sum"] += age
+            c["age_max"] = max(c["age_max"], age)
+        if bytes_stored is not None:
+            c["bytes_stored"] = int(bytes_stored)
+        if entries is not None:
+            c["entries"] = int(entries)
+
+def _cache_note_miss(name: str, key: str, computed_at: float, value: Any, ttl: float) -> None:
+    # Miss st.cache_data: taille de l'entrée; une clé déjà vue en miss = entrée expirée ou évincée
+    try:
+        size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        size = 0
+    reg = _cache_stats_registry()
+    with reg["lock"]:
+        c = _cache_counters(reg, name)
+        sizes = c["sizes"]
+        if _cache_refresh.get():
+            # clear() + recalcul du pré-chauffage: entrée remplacée, ni miss ni éviction
+            c["refreshes"] += 1
+        else:
+            c["misses"] += 1
+            if key in sizes:
+                c["evictions"] += 1
+        sizes[key] = (computed_at, size)
+        # Entrées au-delà du TTL: plus en cache côté Streamlit
+        for k in [k for k, (ts, _) in sizes.items() if computed_at - ts > ttl]:
+            del sizes[k]
+            c["evictions"] += 1
+        c["bytes_stored"] = sum(sz for _, sz in sizes.values())
+        c["entries"] = len(sizes)
+
+def _observed_cache_data(name: str, ttl: int, max_entries: Optional[int] = CACHE_MAX_ENTRIES):
+    # st.cache_data instrumenté: la valeur est stockée avec son heure de calcul,
+    # ce qui distingue hit (calculée avant l'appel) et miss, et donne l'âge au hit
+    def deco(fn):
+        @functools.wraps(fn)
+        def body(*args, **kwargs):
+            return time.time(), fn(*args, **kwargs)
+
+        cached = st.cache_data(ttl=ttl, max_entries=max_entries)(body)
+
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            t0 = time.time()
+            computed_at, value = cached(*args, **kwargs)
+            if computed_at >= t0:
+                key = hashlib.sha1(repr((args, sorted(kwargs.items()))).encode()).hexdigest()
+                _cache_note_miss(name, key, computed_at, value, ttl)
+            else:
+                _cache_note(name, hits=1, ages=[t0 - computed_at])
+            return value
+
+        call.clear = cached.clear
+        return call
+    return deco
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    # Compteurs par cache (st.cache_data, prix, taux, disque), pour le réglage des TTL / max_entries
+    reg = _cache_stats_registry()
+    with reg["lock"]:
+        out = {}
+        for name, c in sorted(reg["caches"].items()):
+            lookups = c["hits"] + c["misses"]
+            out[name] = {
+                "hits": c["hits"],
+                "misses": c["misses"],
+                "hit_ratio": round(c["hits"] / lookups, 3) if lookups else None,
+                "refreshes": c["refreshes"],
+                "entries": c["entries"],
+                "bytes_stored": c["bytes_stored"],
+                "evictions": c["evictions"],
+                "avg_age_at_hit_s": round(c["age_sum"] / c["hits"], 1) if c["hits"] else None,
+                "max_age_at_hit_s": round(c["age_max"], 1),
+            }
+        return out
+
+# -----------------------------------------------------------------------------
+# Cache disque (SQLite): TTL + éviction LRU bornée en taille, partageable entre process
+# -----------------------------------------------------------------------------
+# Connexions SQLite inactives gardées pour réutilisation; intervalle max (s) entre deux passes d'éviction
+DISK_POOL_IDLE = 8
+DISK_EVICT_INTERVAL = 30.0
+
+@st.cache_resource
+def _disk_pool() -> Dict[str, Any]:
+    # Connexions réutilisées entre threads et rendus (une seule utilisatrice à la fois);
+    # schéma créé une fois par process. approx_bytes: total connu + octets écrits depuis la dernière éviction
+    pool = {"lock": threading.Lock(), "idle": [], "approx_bytes": 0, "next_evict": 0.0}
+    conn = _disk_connect()
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS cache ("
+        " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+        " expires REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache(accessed)")
+    conn.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache(expires)")
+    pool["idle"].append(conn)
+    return pool
+
+def _disk_connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DISK_CACHE_PATH, timeout=10, isolation_level=None, check_same_thread=False)
+    # WAL: lecteurs et écrivain concurrents entre process; busy_timeout pour les verrous
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=10000")
+    return conn
+
+@contextlib.contextmanager
+def _disk_conn() -> Iterator[Optional[sqlite3.Connection]]:
+    # Emprunte une connexion au pool (None si le cache disque est désactivé), rendue après usage
+    if not DISK_CACHE_PATH:
+        yield None
+        return
+    pool = _disk_pool()
+    with pool["lock"]:
+        conn = pool["idle"].pop() if pool["idle"] else None
+    if conn is None:
+        conn = _disk_connect()
+    try:
+        yield conn
+    finally:
+        with pool["lock"]:
+            keep = len(pool["idle"]) < DISK_POOL_IDLE
+            if keep:
+                pool["idle"].append(conn)
+        if not keep:
+            conn.close()
+
+def _disk_key(namespace: str, key: str) -> str:
+    return f"{namespace}:{hashlib.sha256(key.encode()).hexdigest()}"
+
+def disk_cache_get_many(namespace: str, keys: List[str]) -> Dict[str, Any]:
+    # Entrées non expirées; un échec SQLite équivaut à un miss
+    try:
+        with _disk_conn() as conn:
+            if conn is None or not keys:
+                return {}
+            by_dk = {_disk_key(namespace, k): k for k in keys}
+            now = time.time()
+            out: Dict[str, Any] = {}
+            dks = list(by_dk)
+            for i in range(0, len(dks), 500):
+                part = dks[i:i+500]
+                marks = ",".join("?" * len(part))
+                rows = conn.execute(f"SELECT key, value FROM cache WHERE key IN ({marks}) AND expires > ?", (*part, now))
+                hits = [(dk, v) for dk, v in rows]
+                if hits:
+                    conn.execute(f"UPDATE cache SET accessed = ? WHERE key IN ({','.join('?' * len(hits))})",
+                                 (now, *[dk for dk, _ in hits]))
+                out.update({by_dk[dk]: json.loads(v) for dk, v in hits})
+        _cache_note("disk", hits=len(out), misses=len(keys) - len(out))
+        return out
+    except (sqlite3.Error, ValueError):
+        return {}
+
+def disk_cache_get(namespace: str, key: str) -> Optional[Any]:
+    return disk_cache_get_many(namespace, [key]).get(key)
+
+def disk_cache_put_many(namespace: str, entries: Dict[str, Any], ttl: float) -> None:
+    try:
+        with _disk_conn() as conn:
+            if conn is None or not entries:
+                return
+            now = time.time()
+            rows = []
+            for k, v in entries.items():
+                blob = json.dumps(v, separators=(",", ":"))
+                rows.append((_disk_key(namespace, k), blob, now + ttl, now, len(blob)))
+            # Éviction périodique, ou dès que le total estimé dépasse la taille max
+            pool = _disk_pool()
+            with pool["lock"]:
+                pool["approx_bytes"] += sum(r[4] for r in rows)
+                evict = (now >= pool["next_evict"]
+                         or pool["approx_bytes"] > DISK_CACHE_MAX_MB * 1024 * 1024)
+                if evict:
+                    pool["next_evict"] = now + DISK_EVICT_INTERVAL
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("INSERT OR REPLACE INTO cache (key, value, expires, accessed, size) VALUES (?, ?, ?, ?, ?)", rows)
+                if evict:
+                    _disk_evict(conn, now)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    except (sqlite3.Error, TypeError, ValueError):
+        pass
+
+def disk_cache_put(namespace: str, key: str, value: Any, ttl: float) -> None:
+    disk_cache_put_many(namespace, {key: value}, ttl)
+
+def _disk_evict(conn: sqlite3.Connection, now: float) -> int:
+    # Expirés d'abord (index sur expires), puis LRU jusqu'à repasser sous 90% de la taille max
+    # (dans la transaction en cours); le total mesuré recale l'estimation du pool
+    evicted = conn.execute("DELETE FROM cache WHERE expires <= ?", (now,)).rowcount
+    total, count = conn.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM cache").fetchone()
+    max_bytes = DISK_CACHE_MAX_MB * 1024 * 1024
+    victims: List[str] = []
+    if total > max_bytes:
+        to_free = total - 0.9 * max_bytes
+        for key, size in conn.execute("SELECT key, size FROM cache ORDER BY accessed ASC"):
+            if to_free <= 0:
+                break
+            victims.append(key)
+            to_free -= size
+        for i in range(0, len(victims), 500):
+            part = victims[i:i+500]
+            conn.execute(f"DELETE FROM cache WHERE key IN ({','.join('?' * len(part))})", part)
+        total, count = conn.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM cache").fetchone()
+    pool = _disk_pool()
+    with pool["lock"]:
+        pool["approx_bytes"] = total
+    _cache_note("disk", evictions=evicted + len(victims), bytes_stored=total, entries=count)
+    return evicted + len(victims)
+
+# Échéance (time.monotonic) du rendu en cours; propagée aux workers par _pool_map
+_render_deadline: contextvars.ContextVar = contextvars.ContextVar("render_deadline", default=None)
+
+# Mode "refresh" (pré-chauffage): les couches de cache sont contournées puis réécrites
+_cache_refresh: contextvars.ContextVar = contextvars.ContextVar("cache_refresh", default=False)
+
+# Thread de fond sans session Streamlit (pré-chauffage et ses workers)
+_background: contextvars.ContextVar = contextvars.ContextVar("background", default=False)
+
+class DeadlineExceeded(TimeoutError):
+    # Budget de rendu épuisé: la donnée sera servie depuis le dernier snapshot
+    pass
+
+def _time_left(cap: float) -> float:
+    # Timeout à utiliser pour un appel réseau: min(cap, temps restant avant l'échéance)
+    deadline = _render_deadline.get()
+    if deadline is None:
+        return cap
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("render budget exhausted")
+    return min(cap, left)
+
+class MorphoThrottled(RuntimeError):
+    # 429 / 5xx: l'API demande de ralentir (distinct d'une erreur GraphQL)
+    def __init__(self, status: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class MorphoCircuitOpen(RuntimeError):
+    # Endpoint en panne: échec immédiat sans appel réseau
+    pass
+
+# Échecs transitoires (réseau / surcharge): retry, et jamais interprétés comme un problème de schéma
+_TRANSIENT_ERRORS = (MorphoThrottled, MorphoCircuitOpen, DeadlineExceeded,
+                     requests.ConnectionError, requests.Timeout)
+
+class _AdaptiveLimiter:
+    # Token bucket (débit) + plafond de requêtes en vol ajusté en AIMD
+    def __init__(self, rate: float, burst: int, max_inflight: int, min_inflight: int = 1):
+        self._cond = threading.Condition()
+        self._rate = max(0.1, float(rate))
+        self._burst = max(1, int(burst))
+        self._tokens = float(self._burst)
+        self._stamp = time.monotonic()
+        self._min, self._max = max(1, min_inflight), max(1, max_inflight)
+        self._limit = float(self._max)
+        self._inflight = 0
+        self._lat_ewma: Optional[float] = None
+        self._done = deque()
+        self._stats = {"requests": 0, "ok": 0, "throttled": 0, "errors": 0, "decreases": 0, "wait_s": 0.0}
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self._rate)
+        self._stamp = now
+
+    def acquire(self, deadline: Optional[float] = None) -> None:
+        t0 = time.monotonic()
+        with self._cond:
+            while True:
+                self._refill()
+                if self._tokens >= 1 and self._inflight < int(self._limit):
+                    self._tokens -= 1
+                    self._inflight += 1
+                    self._stats["requests"] += 1
+                    self._stats["wait_s"] += time.monotonic() - t0
+                    return
+                # Attente du prochain jeton, ou d'une place libérée (notify), bornée par l'échéance
+                timeout = (1 - self._tokens) / self._rate if self._tokens < 1 else None
+                if deadline is not None:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        raise DeadlineExceeded("render budget exhausted waiting for Morpho rate limiter")
+                    timeout = left if timeout is None else min(timeout, left)
+                self._cond.wait(timeout=timeout)
+
+    def release(self, latency: float, outcome: str) -> None:
+        with self._cond:
+            self._inflight -= 1
+            spike = (self._lat_ewma is not None and latency > MORPHO_LATENCY_SPIKE * self._lat_ewma
+                     and latency > 0.5)
+            if outcome == "throttled" or spike:
+                # Décroissance multiplicative
+                self._limit = max(self._min, self._limit / 2)
+                self._stats["decreases"] += 1
+            elif outcome == "ok":
+                # Croissance additive (~ +1 par fenêtre complète)
+                self._limit = min(self._max, self._limit + 1 / self._limit)
+            if outcome == "ok":
+                self._lat_ewma = latency if self._lat_ewma is None else 0.8 * self._lat_ewma + 0.2 * latency
+            self._stats[{"ok": "ok", "throttled": "throttled"}.get(outcome, "errors")] += 1
+            now = time.monotonic()
+            self._done.append(now)
+            while self._done and now - self._done[0] > 60:
+                self._done.popleft()
+            self._cond.notify_all()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._cond:
+            self._refill()
+            return {
+                **self._stats,
+                "wait_s": round(self._stats["wait_s"], 3),
+                "inflight": self._inflight,
+                "concurrency_limit": round(self._limit, 2),
+                "tokens": round(self._tokens, 2),
+                "rate_limit_rps": self._rate,
+                "latency_ewma_s": round(self._lat_ewma, 3) if self._lat_ewma is not None else None,
+                "throughput_rps_60s": round(len(self._done) / 60, 2),
+            }
+
+@st.cache_resource
+def _api_limiter(url: str) -> _AdaptiveLimiter:
+    # Un limiteur par endpoint, partagé par toutes les sessions
+    return _AdaptiveLimiter(MORPHO_RATE_LIMIT, MORPHO_RATE_BURST, MORPHO_MAX_INFLIGHT)
+
+def morpho_throughput_metrics() -> Dict[str, Any]:
+    return _api_limiter(MORPHO_GRAPHQL).metrics()
+
+def _graphql_post(url: str, query: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     payload = {"query": query}
     if variables:
         payload["variables"] = variables
-    r = requests.post(url, json=payload, headers=HTTP_HEADERS, timeout=30)
+    limiter = _api_limiter(url)
+    limiter.acquire(_render_deadline.get())
+    t0 = time.monotonic()
+    outcome = "error"
     try:
-        data = r.json()
-    except Exception:
-        raise RuntimeError(f"GraphQL error [{r.status_code}]: {r.text[:200]}")
+        r = _http_request("POST", url, 30, json=payload, headers=HTTP_HEADERS)
+        if r.status_code == 429 or r.status_code >= 500:
+            outcome = "throttled"
+            retry_after = r.headers.get("Retry-After")
+            raise MorphoThrottled(r.status_code, f"GraphQL throttled [{r.status_code}]: {r.text[:200]}",
+                                  float(retry_after) if (retry_after or "").isdigit() else None)
+        try:
+            data = r.json()
+        except Exception:
+            raise RuntimeError(f"GraphQL error [{r.status_code}]: {r.text[:200]}")
+        outcome = "ok"
+        return data
+    finally:
+        limiter.release(time.monotonic() - t0, outcome)
+
+class _CircuitBreaker:
+    # closed → open après N échecs consécutifs → half-open (1 essai) après cooldown
+    def __init__(self, threshold: int, cooldown: float):
+        self._lock = threading.Lock()
+        self._threshold = max(1, int(threshold))
+        self._cooldown = float(cooldown)
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        # Thread qui détient l'essai half-open (None: aucun)
+        self._probing: Optional[int] = None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing is None and time.monotonic() - self._opened_at >= self._cooldown:
+                self._probing = threading.get_ident()
+                return True
+            return False
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            if ok:
+                self._failures, self._opened_at = 0, None
+            else:
+                self._failures += 1
+                if self._probing is not None or self._failures >= self._threshold:
+                    self._opened_at = time.monotonic()
+            self._probing = None
+
+    def release(self) -> None:
+        # Essai interrompu côté client (échéance de rendu): libère le créneau half-open sans trancher
+        with self._lock:
+            if self._probing == threading.get_ident():
+                self._probing = None
+
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half-open" if self._probing is not None else "open"
+
+@st.cache_resource
+def _circuit_breaker(url: str) -> _CircuitBreaker:
+    return _CircuitBreaker(MORPHO_BREAKER_THRESHOLD, MORPHO_BREAKER_COOLDOWN)
+
+def _backoff_delay(attempt: int, err: Exception) -> float:
+    # Backoff exponentiel, full jitter; Retry-After prioritaire s'il est fourni
+    retry_after = getattr(err, "retry_after", None)
+    if retry_after is not None:
+        return min(float(retry_after), MORPHO_RETRY_MAX_DELAY)
+    return random.uniform(0, min(MORPHO_RETRY_MAX_DELAY, MORPHO_RETRY_BASE_DELAY * (2 ** attempt)))
+
+def _graphql_resilient(url: str, query: str, variables: Optional[Dict[str, Any]],
+                       idempotent: bool = True) -> Dict[str, Any]:
+    # Circuit ouvert: échec immédiat; le repli (snapshot daté, marqué stale) se fait côté appelant
+    breaker = _circuit_breaker(url)
+    if not breaker.allow():
+        raise MorphoCircuitOpen(f"Circuit open for {url} (upstream failing, retry later)")
+    retries = MORPHO_RETRIES if idempotent else 0
+    attempt = 0
+    # Un verdict par appel (pas par tentative); None: essai libéré sans verdict (échéance, 429)
+    outcome: Optional[bool] = None
+    try:
+        while True:
+            try:
+                data = _graphql_post(url, query, variables)
+                outcome = True
+                return data
+            except DeadlineExceeded:
+                raise
+            except _TRANSIENT_ERRORS as e:
+                deadline = _render_deadline.get()
+                if isinstance(e, requests.Timeout) and deadline is not None and time.monotonic() >= deadline:
+                    # Timeout tronqué par notre échéance: pas imputable à l'upstream
+                    raise DeadlineExceeded("render budget exhausted") from e
+                delay = _backoff_delay(attempt, e)
+                if attempt >= retries or delay >= _time_left(float("inf")):
+                    # 429: limite de débit, laissée au limiteur; ne compte pas comme une panne
+                    if not (isinstance(e, MorphoThrottled) and e.status == 429):
+                        outcome = False
+                    raise
+                time.sleep(delay)
+                attempt += 1
+            except Exception:
+                # Corps non JSON, autre RequestException...: échec non retenté, mais compté
+                outcome = False
+                raise
+    finally:
+        if outcome is None:
+            breaker.release()
+        else:
+            breaker.record(outcome)
+
+def morpho_breaker_state() -> str:
+    return _circuit_breaker(MORPHO_GRAPHQL).state()
+
+@_observed_cache_data("graphql", ttl=QUERY_TTL)
+def _run_graphql_cached(url: str, query: str, variables: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    key = json.dumps([url, query, variables or None], sort_keys=True)
+    cached = None if _cache_refresh.get() else disk_cache_get("graphql", key)
+    if cached is not None:
+        return cached
+    # Pas de single-flight maison: st.cache_data sérialise déjà les misses concurrents d'une même clé
+    data = _graphql_resilient(url, query, variables)
+    if "errors" not in data:
+        disk_cache_put("graphql", key, data, DISK_CACHE_TTL)
     return data
 
+def _run_graphql(url: str, query: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    if _cache_refresh.get():
+        # Entrée remplacée; les lectures concurrentes attendent le recalcul (verrou par clé de st.cache_data)
+        _run_graphql_cached.clear(url, query, variables)
+    return _run_graphql_cached(url, query, variables)
+
 def parse_chain_from_market_key(mk: str) -> Optional[int]:
     # La plupart des uniqueKey commencent par le chainId suivi de '-' ou ':'
     try:
@@ -85,234 +693,649 @@ def parse_chain_from_market_key(mk: str) -> Optional[int]:
     except Exception:
         return None
 
-def _to_dec(x) -> Decimal:
+class Amount:
+    # Montant exact en virgule fixe: units / 10**decimals (entiers Python, aucun contexte Decimal)
+    __slots__ = ("units", "decimals")
+
+    def __init__(self, units: int = 0, decimals: int = 0):
+        self.units = units
+        self.decimals = decimals
+
+    def __float__(self) -> float:
+        # int / int: arrondi correct au float le plus proche (projection pour l'affichage)
+        try:
+            return self.units / 10 ** self.decimals
+        except OverflowError:
+            return float("inf") if self.units > 0 else float("-inf")
+
+    def __bool__(self) -> bool:
+        return self.units != 0
+
+    def __mul__(self, other: "Amount") -> "Amount":
+        return Amount(self.units * other.units, self.decimals + other.decimals)
+
+    def __repr__(self) -> str:
+        return f"Amount({self.units}, {self.decimals})"
+
+    def shift(self, decimals: int) -> "Amount":
+        # / 10**decimals, exact (déplacement de la virgule)
+        return Amount(self.units, self.decimals + decimals)
+
+    def exceeds(self, bound: int) -> bool:
+        return self.units > bound * 10 ** self.decimals
+
+_NUM_RE = re.compile(r"\s*([+-]?)(\d*)(?:\.(\d*))?(?:[eE]([+-]?\d{1,4}))?\s*")
+
+def _to_amount(x) -> Amount:
+    # None / invalide → 0; float via str() (repr le plus court), comme Decimal(str(x))
+    if x is None or isinstance(x, bool):
+        return Amount()
+    if isinstance(x, int):
+        return Amount(x, 0)
+    text = str(x)
+    if text.isascii():
+        # Cas courants sans regex: base units entières ("123"), décimal simple ("12.5")
+        if text.isdigit():
+            return Amount(int(text), 0)
+        ip, _, fp = text.partition(".")
+        if fp.isdigit() and (ip.isdigit() or not ip):
+            return Amount(int(ip + fp), len(fp))
+    m = _NUM_RE.fullmatch(text)
+    if m and (m.group(2) or m.group(3)):
+        sign, ip, fp, ex = m.groups()
+        fp = fp or ""
+        units, exp = int((ip or "") + fp), int(ex or 0) - len(fp)
+        units = -units if sign == "-" else units
+    else:
+        # Formats rares ('1_000', chiffres unicode...): construction Decimal exacte, hors contexte
+        try:
+            d = Decimal(text)
+        except (InvalidOperation, ValueError):
+            return Amount()
+        if not d.is_finite():
+            return Amount()
+        sign, digits, exp = d.as_tuple()
+        units = int("".join(map(str, digits)) or "0") * (-1 if sign else 1)
+    if abs(exp) > 4096:
+        # Exposant absurde: on n'alloue pas un entier de cette taille
+        return Amount()
+    return Amount(units * 10 ** exp, 0) if exp > 0 else Amount(units, -exp)
+
+def _thread_pool(max_workers: int) -> ThreadPoolExecutor:
+    # Les workers héritent du contexte Streamlit de la session (cache_data, secrets)
+    ctx = get_script_run_ctx(suppress_warning=True) if get_script_run_ctx else None
+    init = (lambda: add_script_run_ctx(None, ctx)) if ctx is not None else None
+    return ThreadPoolExecutor(max_workers=max(1, int(max_workers)), initializer=init)
+
+def _pool_iter(fn, items: List[Any], max_workers: int = MORPHO_MAX_WORKERS) -> Iterator[Tuple[int, Any]]:
+    # Exécute fn(item) en parallèle; produit (index, résultat ou exception) au fil des complétions.
+    # Les items encore en cours à l'échéance du rendu valent DeadlineExceeded.
+    if not items:
+        return
+    deadline = _render_deadline.get()
+    ex = _thread_pool(min(max_workers, len(items)))
+    # Une copie du contexte par tâche: l'échéance suit chaque worker
+    futs = {ex.submit(contextvars.copy_context().run, fn, it): i for i, it in enumerate(items)}
+    pending = set(futs)
     try:
-        if x is None:
-            return Decimal(0)
-        if isinstance(x, (int, float)):
-            return Decimal(str(x))
-        return Decimal(str(x))
-    except (InvalidOperation, ValueError):
-        return Decimal(0)
-
-def _norm(raw: Decimal, decimals: int) -> Decimal:
-    # Si l'ordre de grandeur indique des base units, on / 10**decimals
-    threshold = Decimal(10) ** (decimals + 2)
-    if raw > threshold:
-        return raw / (Decimal(10) ** decimals)
-    return raw
-
-def _fetch_prices(price_keys: List[str]) -> Dict[str, Any]:
-    if not price_keys:
-        return {}
+        while pending:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for f in done:
+                try:
+                    res = f.result()
+                except Exception as e:
+                    res = e
+                yield futs[f], res
+        for f in pending:
+            yield futs[f], DeadlineExceeded("render budget exhausted")
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
+
+def _pool_map(fn, items: List[Any], max_workers: int = MORPHO_MAX_WORKERS) -> List[Any]:
+    # Comme _pool_iter, résultats rangés dans l'ordre d'entrée
+    results: List[Any] = [None] * len(items)
+    for i, res in _pool_iter(fn, items, max_workers):
+        results[i] = res
+    return results
+
+def _within_deadline(fn, *args):
+    # Appel unique passé par le pool: l'attente (verrous par clé de st.cache_data compris) est bornée
+    # par l'échéance du rendu; l'appel en cours se termine en arrière-plan et remplit les caches
+    res = _pool_map(lambda _: fn(*args), [None], 1)[0]
+    if isinstance(res, Exception):
+        raise res
+    return res
+
+def _price_chunks(keys: List[str], max_url: int = DEFILLAMA_MAX_URL) -> List[List[str]]:
+    # Découpe les clés pour que chaque URL reste sous max_url caractères
+    budget = max(1, max_url - len(DEFILLAMA_PRICES))
+    chunks: List[List[str]] = []
+    cur: List[str] = []
+    size = 0
+    for k in keys:
+        add = len(k) + (1 if cur else 0)  # +1 pour la virgule
+        if cur and size + add > budget:
+            chunks.append(cur)
+            cur, size, add = [], 0, len(k)
+        cur.append(k)
+        size += add
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+def _fetch_price_chunk(keys: List[str]) -> Dict[str, Any]:
+    resp = _http_request("GET", DEFILLAMA_PRICES + ",".join(keys), 15)
+    resp.raise_for_status()
+    return (resp.json() or {}).get("coins", {}) or {}
+
+def _fetch_prices(price_keys: List[str]) -> Tuple[Dict[str, Any], List[str]]:
+    # (prix fusionnés, erreurs par chunk): un chunk en échec ne vide pas les autres
+    keys = sorted(set(k for k in price_keys if k))
+    if not keys:
+        return {}, []
+    chunks = _price_chunks(keys)
+    prices: Dict[str, Any] = {}
+    errors: List[str] = []
+    for chunk, res in zip(chunks, _pool_map(_fetch_price_chunk, chunks, DEFILLAMA_MAX_WORKERS)):
+        if isinstance(res, Exception):
+            errors.append(f"DefiLlama prices failed for {len(chunk)} keys ({chunk[0]}…) → {res}")
+        else:
+            prices.update(res)
+    return prices, errors
+
+@st.cache_resource
+def _price_cache() -> Dict[str, Any]:
+    # chain:address -> (ts, entrée coins DefiLlama ou None si prix inconnu)
+    return {"lock": threading.Lock(), "entries": {}, "refreshing": set()}
+
+def _store_prices(keys: List[str], prices: Dict[str, Any], errors: List[str]) -> None:
+    cache = _price_cache()
+    now = time.time()
+    stored: Dict[str, Any] = {}
+    with cache["lock"]:
+        for k in keys:
+            if k in prices:
+                cache["entries"][k] = stored[k] = (now, prices[k])
+            elif not errors:
+                # Absent d'une réponse complète: prix inconnu, mis en cache aussi
+                cache["entries"][k] = stored[k] = (now, None)
+        n_bytes = sum(len(k) + len(json.dumps(v)) for k, (_, v) in cache["entries"].items())
+        n_entries = len(cache["entries"])
+    _cache_note("prices", entries=n_entries, bytes_stored=n_bytes)
+    disk_cache_put_many("price", stored, PRICE_TTL + PRICE_STALE_MAX)
+
+def _refresh_prices_bg(keys: List[str]) -> None:
+    cache = _price_cache()
     try:
-        url = "https://coins.llama.fi/prices/current/" + ",".join(sorted(set(price_keys)))
-        resp = requests.get(url, timeout=15)
-        return (resp.json() or {}).get("coins", {}) or {}
-    except Exception:
-        return {}
-
-def _price_from_llama(prices: Dict[str, Any], chain_id: Optional[int], token_addr: str) -> Optional[Decimal]:
-    if chain_id not in CHAIN_SLUG or not token_addr:
+        prices, errors = _fetch_prices(keys)
+        _store_prices(keys, prices, errors)
+    finally:
+        with cache["lock"]:
+            cache["refreshing"].difference_update(keys)
+
+def cached_prices(price_keys: List[str], ttl: int = PRICE_TTL) -> Tuple[Dict[str, Any], List[str]]:
+    # Frais → servis; périmés → servis + rafraîchis en arrière-plan; absents/trop vieux → fetch
+    keys = sorted(set(k for k in price_keys if k))
+    cache = _price_cache()
+    with cache["lock"]:
+        cold = [k for k in keys if k not in cache["entries"]]
+    # Process (re)démarré: réchauffe la mémoire depuis le cache disque, avec l'horodatage d'origine
+    warm = disk_cache_get_many("price", cold)
+    if warm:
+        with cache["lock"]:
+            for k, (ts, v) in warm.items():
+                cache["entries"].setdefault(k, (ts, v))
+    now = time.time()
+    out: Dict[str, Any] = {}
+    missing: List[str] = []
+    stale: List[str] = []
+    ages: List[float] = []
+    with cache["lock"]:
+        for k in keys:
+            hit = cache["entries"].get(k)
+            age = (now - hit[0]) if hit else None
+            if hit is None or age > ttl + PRICE_STALE_MAX:
+                missing.append(k)
+                continue
+            ages.append(age)
+            if hit[1] is not None:
+                out[k] = hit[1]
+            if age > ttl and k not in cache["refreshing"]:
+                stale.append(k)
+        cache["refreshing"].update(stale)
+    _cache_note("prices", hits=len(ages), misses=len(missing), ages=ages)
+
+    if stale:
+        threading.Thread(target=_refresh_prices_bg, args=(stale,), daemon=True).start()
+
+    errors: List[str] = []
+    if missing:
+        fetched, errors = _fetch_prices(missing)
+        _store_prices(missing, fetched, errors)
+        out.update({k: v for k, v in fetched.items() if k in missing})
+    return out, errors
+
+def peek_prices(price_keys: List[str]) -> Dict[str, Any]:
+    # Prix déjà en cache (frais ou périmés), sans aucun appel réseau
+    cache = _price_cache()
+    with cache["lock"]:
+        hits = {k: cache["entries"].get(k) for k in set(price_keys)}
+    return {k: hit[1] for k, hit in hits.items() if hit is not None and hit[1] is not None}
+
+def _price_from_llama(prices: Dict[str, Any], key: Optional[str]) -> Optional[Amount]:
+    # key: "slug:adresse" précalculée dans l'index des marchés
+    if not key:
         return None
-    key = f"{CHAIN_SLUG[chain_id]}:{token_addr.lower()}"
     p = (prices.get(key) or {}).get("price")
     try:
-        return Decimal(str(p)) if p is not None else None
+        return _to_amount(p) if p is not None else None
     except Exception:
         return None
 
+# -----------------------------------------------------------------------------
+# Capacités du schéma Morpho (persistées, TTL long)
+# -----------------------------------------------------------------------------
+@st.cache_resource
+def _capability_store() -> Dict[str, Any]:
+    # Partagé entre sessions et survivant aux expirations de st.cache_data
+    return {"lock": threading.Lock(), "entries": {}}
+
+def _cap_get(name: str) -> Optional[Any]:
+    store = _capability_store()
+    with store["lock"]:
+        hit = store["entries"].get(name)
+    if hit is None or (time.time() - hit[0]) > CAPABILITY_TTL:
+        return None
+    return hit[1]
+
+def _cap_set(name: str, value: Any) -> None:
+    store = _capability_store()
+    with store["lock"]:
+        store["entries"][name] = (time.time(), value)
+
+def _cap_drop(name: str) -> None:
+    store = _capability_store()
+    with store["lock"]:
+        store["entries"].pop(name, None)
+
+# -----------------------------------------------------------------------------
+# Registre des tokens: "chainId:adresse" → décimales / symbole (API Morpho assets, persisté)
+# -----------------------------------------------------------------------------
+ASSETS_QUERY = """
+query($addresses: [String!], $chains: [Int!], $first: Int) {
+  assets(first: $first, where: { address_in: $addresses, chainId_in: $chains }) {
+    items { address decimals symbol chain { id } }
+  }
+}
+"""
+ASSETS_BATCH_SIZE = 300
+
+@st.cache_resource
+def _token_registry() -> Dict[str, Any]:
+    return {"lock": threading.Lock(), "entries": {}}
+
+def token_key(chain_id: Optional[int], address: str) -> Optional[str]:
+    if chain_id is None or not address:
+        return None
+    return f"{int(chain_id)}:{address.lower()}"
+
+def _fetch_tokens(keys: List[str]) -> Optional[Dict[str, Dict[str, Any]]]:
+    # Une requête assets par lot d'adresses (toutes chaînes confondues), résultats filtrés sur les clés demandées;
+    # None si la forme de requête est rejetée par le schéma
+    wanted = set(keys)
+    out: Dict[str, Dict[str, Any]] = {}
+    addrs = sorted({k.split(":", 1)[1] for k in wanted})
+    chains = sorted({int(k.split(":", 1)[0]) for k in wanted})
+    for part in _chunks(addrs, ASSETS_BATCH_SIZE):
+        variables = {"addresses": part, "chains": chains, "first": len(part) * len(chains)}
+        payload = _run_graphql(MORPHO_GRAPHQL, ASSETS_QUERY, variables)
+        if "errors" in payload:
+            msgs = ", ".join([e.get("message", "") for e in payload.get("errors", [])])
+            if "NOT_FOUND" in msgs or "No results matching" in msgs:
+                continue
+            return None
+        for a in (((payload.get("data") or {}).get("assets") or {}).get("items") or []):
+            k = token_key((a.get("chain") or {}).get("id"), a.get("address") or "")
+            if k in wanted and a.get("decimals") is not None:
+                out[k] = {"decimals": int(a["decimals"]), "symbol": a.get("symbol"), "chain": int(k.split(":")[0])}
+    return out
+
+def token_registry(keys: List[str], fetch: bool = True) -> Dict[str, Dict[str, Any]]:
+    # Mémoire → disque → API (en bloc); fetch=False: uniquement ce qui est déjà connu, sans réseau
+    # Entrées {"decimals": None, "ts": ...}: token inconnu de l'API, non re-demandé avant TOKEN_UNKNOWN_TTL
+    wanted = sorted(set(k for k in keys if k))
+    reg = _token_registry()
+    now = time.time()
+    with reg["lock"]:
+        hits = {k: reg["entries"][k] for k in wanted if k in reg["entries"]}
+    hits = {k: v for k, v in hits.items() if v["decimals"] is not None or now - v["ts"] <= TOKEN_UNKNOWN_TTL}
+    out = {k: v for k, v in hits.items() if v["decimals"] is not None}
+    missing = [k for k in wanted if k not in hits]
+    if not fetch:
+        return out
+    _cache_note("tokens", hits=len(hits), misses=len(missing))
+    if not missing:
+        return out
+
+    found = disk_cache_get_many("tokens", missing)
+    remaining = [k for k in missing if k not in found]
+    if remaining and _cap_get("assets_query") is not False:
+        try:
+            fetched = _fetch_tokens(remaining)
+        except Exception:
+            # Transitoire / réponse illisible: rien n'est mémorisé, nouvel essai au prochain rendu
+            fetched = {}
+        else:
+            if fetched is None:
+                # Schéma sans assets(where: address_in): décimales embarquées dans les positions
+                _cap_set("assets_query", False)
+                fetched = {}
+            else:
+                unknown = {k: {"decimals": None, "ts": now} for k in remaining if k not in fetched}
+                disk_cache_put_many("tokens", unknown, TOKEN_UNKNOWN_TTL)
+                found.update(unknown)
+        disk_cache_put_many("tokens", fetched, TOKEN_TTL)
+        found.update(fetched)
+    with reg["lock"]:
+        reg["entries"].update(found)
+        n_entries = len(reg["entries"])
+        n_bytes = sum(len(k) + len(v.get("symbol") or "") + 16 for k, v in reg["entries"].items())
+    _cache_note("tokens", entries=n_entries, bytes_stored=n_bytes)
+    out.update({k: v for k, v in found.items() if v["decimals"] is not None})
+    return out
+
 # -----------------------------------------------------------------------------
 # Morpho — per-wallet positions (strict)
 # -----------------------------------------------------------------------------
-@st.cache_data(ttl=300)
-def morpho_user_positions(address: str, chain_ids: Optional[List[int]] = None) -> List[Dict[str, Any]]:
-    # Retourne UNIQUEMENT les positions du wallet; montants par user dans state{...}
+POSITIONS_QUERY_TPL = """
+query {{
+  marketPositions(
+    first: {first},
+    skip: {skip},
+    where: {{ userAddress_in: [{addresses}]{chains_clause} }}
+  ) {{
+    items {{
+      market {{
+        uniqueKey
+        whitelisted
+        loanAsset {{ symbol address decimals }}
+        collateralAsset {{ symbol address decimals }}{market_rates}
+      }}
+      user {{ address }}
+      state {{
+        supplyAssets
+        supplyAssetsUsd
+        borrowAssets
+        borrowAssetsUsd
+        collateral
+        collateralUsd
+      }}
+    }}
+    pageInfo {{ countTotal }}
+  }}
+}}
+"""
+POSITIONS_PAGE_SIZE = 300
+
+def _positions_query(addresses: List[str], chain_ids: Optional[List[int]] = None, skip: int = 0,
+                     rate_selection: Optional[str] = None) -> str:
     chains_clause = ""
     if chain_ids:
         uniq = ",".join(str(int(c)) for c in sorted(set(chain_ids)))
         chains_clause = f", chainId_in: [{uniq}]"
+    addr_list = ", ".join(f'"{a}"' for a in addresses)
+    market_rates = f"\n        {rate_selection}" if rate_selection else ""
+    return POSITIONS_QUERY_TPL.format(first=POSITIONS_PAGE_SIZE, skip=int(skip), addresses=addr_list,
+                                      chains_clause=chains_clause, market_rates=market_rates)
+
+def _positions_rate_selection() -> Optional[str]:
+    # Champs de taux à embarquer dans market{...}, seulement si le schéma les a déjà servis
+    if not MORPHO_COMBINED_RATES or _cap_get("positions_rates") is False:
+        return None
+    known = _cap_get("borrow_apy_query")
+    if not known or known.get("mode") != "markets":
+        return None
+    return known["selection"].replace("uniqueKey", "", 1).strip() or None
 
-    query_tpl = """
-    query {{
-      marketPositions(
-        first: 300,
-        where: {{ userAddress_in: ["{address}"]{chains_clause} }}
-      ) {{
-        items {{
-          market {{
-            uniqueKey
-            whitelisted
-            loanAsset {{ symbol address decimals }}
-            collateralAsset {{ symbol address decimals }}
-          }}
-          user {{ address }}
-          state {{
-            supplyAssets
-            supplyAssetsUsd
-            borrowAssets
-            borrowAssetsUsd
-            collateral
-            collateralUsd
-          }}
-        }}
-      }}
-    }}
-    """
-    q = query_tpl.format(address=address, chains_clause=chains_clause)
-    payload = _run_graphql(MORPHO_GRAPHQL, q)
-
+def _positions_page(payload: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    # (items, countTotal) d'une page marketPositions
     if "errors" in payload:
         msgs = ", ".join([e.get("message", "") for e in payload.get("errors", [])])
         if "NOT_FOUND" in msgs or "No results matching" in msgs:
-            return []
+            return [], 0
         raise RuntimeError(f"Morpho API error: {payload['errors']}")
-
-    items = (((payload or {}).get("data") or {}).get("marketPositions") or {}).get("items", [])
-    # Double filtre côté client par sécurité
-    items = [it for it in items if (it.get("user") or {}).get("address", "").lower() == address.lower()]
-
-    # Dé-dup (rare)
+    mp = ((payload or {}).get("data") or {}).get("marketPositions") or {}
+    total = (mp.get("pageInfo") or {}).get("countTotal")
+    return mp.get("items", []) or [], (int(total) if total is not None else None)
+
+def _rate_fields_rejected(payload: Dict[str, Any], rate_selection: str) -> bool:
+    # Erreur GraphQL qui cite un des champs de taux embarqués (champ inconnu du schéma)
+    fields = set(re.findall(r"[A-Za-z_]\w*", rate_selection))
+    msgs = [e.get("message", "") for e in (payload or {}).get("errors") or []]
+    return any("field" in m.lower() and any(re.search(rf"\b{f}\b", m) for f in fields) for m in msgs)
+
+def _fetch_all_positions(addresses: List[str], chain_ids: Optional[List[int]] = None,
+                         rate_selection: Optional[str] = None) -> List[Dict[str, Any]]:
+    def _payload(skip: int) -> Dict[str, Any]:
+        return _run_graphql(MORPHO_GRAPHQL, _positions_query(addresses, chain_ids, skip, rate_selection))
+
+    def _page(skip: int) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        return _positions_page(_payload(skip))
+
+    # Les échecs transitoires remontent tels quels: seul un refus explicite du schéma désactive le mode combiné
+    first = _payload(0)
+    if rate_selection and _rate_fields_rejected(first, rate_selection):
+        # Taux refusés dans market{...}: mode combiné désactivé, requête simple
+        _cap_set("positions_rates", False)
+        rate_selection = None
+        first = _payload(0)
+    first_items, total = _positions_page(first)
+
+    # Page 0, puis les pages restantes en parallèle une fois countTotal connu
+    pages = [first_items]
+    if total is not None:
+        skips = list(range(POSITIONS_PAGE_SIZE, total, POSITIONS_PAGE_SIZE))
+        for res in _pool_map(lambda sk: _page(sk)[0], skips, MORPHO_PAGE_WORKERS):
+            if isinstance(res, Exception):
+                raise res
+            pages.append(res)
+    else:
+        # Pas de pageInfo: on suit séquentiellement tant que la page est pleine
+        skip = 0
+        while len(pages[-1]) >= POSITIONS_PAGE_SIZE:
+            skip += POSITIONS_PAGE_SIZE
+            pages.append(_page(skip)[0])
+    return [it for page in pages for it in page]
+
+def _split_positions(items: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    # Ventilation par user.address (minuscule) + dé-dup par uniqueKey, en une passe
+    out: Dict[str, List[Dict[str, Any]]] = {}
     seen = set()
-    deduped: List[Dict[str, Any]] = []
     for it in items:
+        user = ((it.get("user") or {}).get("address") or "").lower()
         mk = ((it.get("market") or {}).get("uniqueKey"))
-        if mk and mk in seen:
+        if mk and (user, mk) in seen:
             continue
-        seen.add(mk)
-        deduped.append(it)
-    return deduped
+        seen.add((user, mk))
+        out.setdefault(user, []).append(it)
+    return out
+
+def _chunks(seq: List[Any], size: int) -> List[List[Any]]:
+    size = max(1, int(size))
+    return [seq[i:i+size] for i in range(0, len(seq), size)]
+
+def _canon_chains(chain_ids: Optional[List[int]]) -> Optional[List[int]]:
+    # [8453, 1] et [1, 8453, 1] → [1, 8453]: une seule entrée de cache
+    return sorted(set(int(c) for c in chain_ids)) if chain_ids else None
+
+# Le mode combiné (taux embarqués) ne fait pas partie des clés de cache: une entrée avec ou sans taux
+# reste valide (les marchés sans taux embarqué passent par le lookup APY), et l'activation du mode
+# après la découverte ne provoque pas de re-fetch de tout le book
+@_observed_cache_data("positions", ttl=QUERY_TTL)
+def _user_positions_cached(address: str, chain_ids: Optional[List[int]]) -> List[Dict[str, Any]]:
+    disk_key = json.dumps([address, chain_ids])
+    cached = None if _cache_refresh.get() else disk_cache_get("positions", disk_key)
+    if cached is not None:
+        return cached
+    # Double filtre côté client par sécurité (seuls les items de ce user sont gardés)
+    items = _split_positions(_fetch_all_positions([address], chain_ids, _positions_rate_selection())).get(address, [])
+    disk_cache_put("positions", disk_key, items, DISK_CACHE_TTL)
+    return items
+
+def morpho_user_positions(address: str, chain_ids: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+    # Retourne UNIQUEMENT les positions du wallet; montants par user dans state{...}
+    # Clé de cache canonique: adresse en minuscules, chaînes triées
+    args = (address.lower(), _canon_chains(chain_ids))
+    if _cache_refresh.get():
+        _user_positions_cached.clear(*args)
+    return _user_positions_cached(*args)
+
+@_observed_cache_data("positions_batch", ttl=QUERY_TTL)
+def _user_positions_batch_cached(addresses: List[str], chain_ids: Optional[List[int]]) -> Dict[str, List[Dict[str, Any]]]:
+    by_user = _split_positions(_fetch_all_positions(addresses, chain_ids, _positions_rate_selection()))
+    return {addr: by_user.get(addr, []) for addr in addresses}
+
+def morpho_user_positions_batch(addresses: List[str], chain_ids: Optional[List[int]] = None) -> Dict[str, List[Dict[str, Any]]]:
+    # Une seule requête pour plusieurs wallets (userAddress_in), puis ventilation par user.address
+    if not addresses:
+        return {}
+    args = (sorted(set(a.lower() for a in addresses)), _canon_chains(chain_ids))
+    if _cache_refresh.get():
+        _user_positions_batch_cached.clear(*args)
+    by_lc = _user_positions_batch_cached(*args)
+    return {addr: by_lc.get(addr.lower(), []) for addr in addresses}
+
+def morpho_positions_for_wallets(addresses: List[str], chain_ids: Optional[List[int]] = None,
+                                 chunk_size: int = MORPHO_BATCH_SIZE,
+                                 max_workers: int = MORPHO_MAX_WORKERS,
+                                 on_wallet: Optional[Callable[[str, Any], None]] = None) -> Dict[str, Any]:
+    # addr -> liste d'items, ou l'exception levée pour ce wallet.
+    # on_wallet(addr, résultat) est appelé dans le thread appelant dès qu'un wallet est prêt.
+    # Chunks construits sur les adresses canoniques triées: mêmes wallets → mêmes clés de cache
+    by_lc: Dict[str, List[str]] = {}
+    for addr in addresses:
+        by_lc.setdefault(addr.lower(), []).append(addr)
+    chunks = _chunks(sorted(by_lc), chunk_size)
+
+    def _notify(lc: str, res: Any) -> None:
+        if on_wallet:
+            for addr in by_lc[lc]:
+                on_wallet(addr, res)
+
+    out: Dict[str, Any] = {}
+    retry: List[str] = []
+    for ci, res in _pool_iter(lambda c: morpho_user_positions_batch(c, chain_ids), chunks, max_workers):
+        if isinstance(res, Exception):
+            retry.extend(chunks[ci])
+            continue
+        out.update(res)
+        for lc in chunks[ci]:
+            _notify(lc, res.get(lc, []))
+
+    # Fallback: un appel par wallet (toujours en parallèle) pour isoler l'erreur
+    for ri, res in _pool_iter(lambda a: morpho_user_positions(a, chain_ids), retry, max_workers):
+        out[retry[ri]] = res
+        _notify(retry[ri], res)
+    return {addr: out.get(addr.lower(), []) for addr in addresses}
 
 # -----------------------------------------------------------------------------
 # Borrow APY par marché (ultra-robuste: markets → introspection → marketByUniqueKey)
 # -----------------------------------------------------------------------------
-@st.cache_data(ttl=300)
-def morpho_market_borrow_apys(unique_keys: List[str]) -> Dict[str, float]:
-    keys = [k for k in dict.fromkeys(unique_keys) if k]
-    if not keys:
-        return {}
-
-    def _extract(items) -> Dict[str, float]:
-        out: Dict[str, float] = {}
-        for it in items or []:
-            uk = it.get("uniqueKey")
-            rates = it.get("rates") or {}
-            apy   = it.get("apy") or {}
-            stt   = it.get("state") or {}
-            # Premier champ dispo dans l'ordre
-            val = (
-                rates.get("borrowApy") or apy.get("borrowApy")
-                or rates.get("borrowApr") or apy.get("borrowApr")
-                or stt.get("borrowRate") or stt.get("borrowApr") or stt.get("borrowApy")
-            )
-            if (uk is not None) and (val is not None):
-                try:
-                    out[uk] = float(val)
-                except Exception:
-                    pass
-        return out
+MARKET_RATE_SELECTIONS = [
+    "uniqueKey rates { borrowApy borrowApr } apy { borrowApy borrowApr } state { borrowRate borrowApr borrowApy }",
+    "uniqueKey rates { borrowApy borrowApr } state { borrowRate }",
+    "uniqueKey apy { borrowApy borrowApr }",
+]
 
-    # 1) Tentatives via markets(...)
-    variants = [
-        """
-        query($keys:[String!]) {
-          markets(first:300, where:{ uniqueKey_in: $keys }) {
-            items {
-              uniqueKey
-              rates { borrowApy borrowApr }
-              apy   { borrowApy borrowApr }
-              state { borrowRate borrowApr borrowApy }
-            }
-          }
-        }
-        """,
-        """
-        query($keys:[String!]) {
-          markets(first:300, where:{ uniqueKey_in: $keys }) {
-            items {
-              uniqueKey
-              rates { borrowApy borrowApr }
-              state { borrowRate }
-            }
-          }
-        }
-        """,
-        """
-        query($keys:[String!]) {
-          markets(first:300, where:{ uniqueKey_in: $keys }) {
-            items {
-              uniqueKey
-              apy { borrowApy borrowApr }
-            }
-          }
-        }
-        """,
-    ]
-    for gql in variants:
-        try:
-            data = _run_graphql(MORPHO_GRAPHQL, gql, {"keys": keys})
-            if "errors" in data:
-                continue
-            items = (((data.get("data") or {}).get("markets") or {}).get("items") or [])
-            apys = _extract(items)
-            if apys:
-                return apys
-        except Exception:
-            pass
+def _markets_rates_query(selection: str) -> str:
+    return f"""
+    query($keys:[String!]) {{
+      markets(first:300, where:{{ uniqueKey_in: $keys }}) {{
+        items {{ {selection} }}
+      }}
+    }}
+    """
 
-    # 2) Introspection pour savoir quels champs existent réellement
-    try:
-        introspect = """
-        query {
-          t1: __type(name:"Market") { fields { name } }
-          t2: __type(name:"MarketRates") { fields { name } }
-          t3: __type(name:"MarketApy") { fields { name } }
-          t4: __type(name:"MarketState") { fields { name } }
-        }
-        """
-        data = _run_graphql(MORPHO_GRAPHQL, introspect)
-        f_market = {f.get("name") for f in (((data.get("data") or {}).get("t1") or {}).get("fields") or [])}
-        f_rates  = {f.get("name") for f in (((data.get("data") or {}).get("t2") or {}).get("fields") or [])}
-        f_apy    = {f.get("name") for f in (((data.get("data") or {}).get("t3") or {}).get("fields") or [])}
-        f_state  = {f.get("name") for f in (((data.get("data") or {}).get("t4") or {}).get("fields") or [])}
-
-        want_rates_apr = "borrowApr" in f_rates
-        want_rates_apy = "borrowApy" in f_rates
-        want_apy_apr   = "borrowApr" in f_apy
-        want_apy_apy   = "borrowApy" in f_apy
-        want_state     = ("borrowRate" in f_state) or ("borrowApr" in f_state) or ("borrowApy" in f_state)
-
-        sel_parts = ["uniqueKey"]
-        if "rates" in f_market and (want_rates_apr or want_rates_apy):
-            need = " ".join([x for x in ["borrowApy" if want_rates_apy else None, "borrowApr" if want_rates_apr else None] if x])
+def _extract_borrow_apys(items) -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for it in items or []:
+        uk = it.get("uniqueKey")
+        rates = it.get("rates") or {}
+        apy   = it.get("apy") or {}
+        stt   = it.get("state") or {}
+        # Premier champ dispo dans l'ordre
+        val = (
+            rates.get("borrowApy") or apy.get("borrowApy")
+            or rates.get("borrowApr") or apy.get("borrowApr")
+            or stt.get("borrowRate") or stt.get("borrowApr") or stt.get("borrowApy")
+        )
+        if (uk is not None) and (val is not None):
+            try:
+                out[uk] = float(val)
+            except Exception:
+                pass
+    return out
+
+def _introspected_fields() -> Dict[str, List[str]]:
+    # Champs réellement exposés par le schéma (mis en cache avec les capacités)
+    fields = _cap_get("schema_fields")
+    if fields is not None:
+        return fields
+    introspect = """
+    query {
+      t1: __type(name:"Market") { fields { name } }
+      t2: __type(name:"MarketRates") { fields { name } }
+      t3: __type(name:"MarketApy") { fields { name } }
+      t4: __type(name:"MarketState") { fields { name } }
+    }
+    """
+    data = _run_graphql(MORPHO_GRAPHQL, introspect)
+    if "errors" in data:
+        raise RuntimeError(f"Morpho introspection error: {data['errors']}")
+    fields = {
+        name: sorted({f.get("name") for f in (((data.get("data") or {}).get(alias) or {}).get("fields") or [])} - {None})
+        for alias, name in (("t1", "market"), ("t2", "rates"), ("t3", "apy"), ("t4", "state"))
+    }
+    _cap_set("schema_fields", fields)
+    return fields
+
+def _introspected_selection(fields: Dict[str, List[str]]) -> Optional[str]:
+    f_market, f_rates = set(fields.get("market", [])), set(fields.get("rates", []))
+    f_apy, f_state = set(fields.get("apy", [])), set(fields.get("state", []))
+
+    sel_parts = ["uniqueKey"]
+    if "rates" in f_market:
+        need = " ".join(x for x in ("borrowApy", "borrowApr") if x in f_rates)
+        if need:
             sel_parts.append(f"rates {{ {need} }}")
-        if "apy" in f_market and (want_apy_apr or want_apy_apy):
-            need = " ".join([x for x in ["borrowApy" if want_apy_apy else None, "borrowApr" if want_apy_apr else None] if x])
+    if "apy" in f_market:
+        need = " ".join(x for x in ("borrowApy", "borrowApr") if x in f_apy)
+        if need:
             sel_parts.append(f"apy {{ {need} }}")
-        if "state" in f_market and want_state:
-            need = " ".join([x for x in ["borrowRate" if "borrowRate" in f_state else None,
-                                         "borrowApr"  if "borrowApr"  in f_state else None,
-                                         "borrowApy"  if "borrowApy"  in f_state else None] if x])
+    if "state" in f_market:
+        need = " ".join(x for x in ("borrowRate", "borrowApr", "borrowApy") if x in f_state)
+        if need:
             sel_parts.append(f"state {{ {need} }}")
-        if len(sel_parts) > 1:
-            gql = f"""
-            query($keys:[String!]) {{
-              markets(first:300, where:{{ uniqueKey_in: $keys }}) {{
-                items {{ {' '.join(sel_parts)} }}
-              }}
-            }}
-            """
-            data2 = _run_graphql(MORPHO_GRAPHQL, gql, {"keys": keys})
-            if "errors" not in data2:
-                items = (((data2.get("data") or {}).get("markets") or {}).get("items") or [])
-                apys = _extract(items)
-                if apys:
-                    return apys
+    return " ".join(sel_parts) if len(sel_parts) > 1 else None
+
+def _apys_via_markets(selection: str, keys: List[str]) -> Optional[Dict[str, float]]:
+    # None si la forme de requête est rejetée par le schéma
+    try:
+        data = _run_graphql(MORPHO_GRAPHQL, _markets_rates_query(selection), {"keys": keys})
+    except _TRANSIENT_ERRORS:
+        raise
     except Exception:
-        pass
+        return None
+    if "errors" in data:
+        return None
+    return _extract_borrow_apys(((data.get("data") or {}).get("markets") or {}).get("items") or [])
 
-    # 3) Fallback final: marketByUniqueKey par batch (alias)
-    def _fetch_batch(batch_keys: List[str]) -> Dict[str, float]:
+def _apys_via_unique_key(keys: List[str]) -> Optional[Dict[str, float]]:
+    # Fallback final: marketByUniqueKey par batch (alias); None si la requête est rejetée
+    def _fetch_batch(batch_keys: List[str]) -> Optional[Dict[str, float]]:
         alias_blocks = []
         for i, k in enumerate(batch_keys):
             alias_blocks.append(f"""
@@ -327,117 +1350,267 @@ def morpho_market_borrow_apys(unique_keys: List[str]) -> Dict[str, float]:
         try:
             data = _run_graphql(MORPHO_GRAPHQL, q)
             if "errors" in data:
-                return {}
-            return _extract(list((data.get("data") or {}).values()))
+                msgs = ", ".join([e.get("message", "") for e in data.get("errors", [])])
+                if "NOT_FOUND" not in msgs and "No results matching" not in msgs:
+                    return None
+            return _extract_borrow_apys([m for m in (data.get("data") or {}).values() if m])
+        except _TRANSIENT_ERRORS:
+            raise
         except Exception:
-            return {}
+            return None
 
     apys_total: Dict[str, float] = {}
     CHUNK = 20
     for i in range(0, len(keys), CHUNK):
-        apys_total.update(_fetch_batch(keys[i:i+CHUNK]))
+        apys = _fetch_batch(keys[i:i+CHUNK])
+        if apys is None:
+            return None
+        apys_total.update(apys)
     return apys_total
 
+def _discover_borrow_apys(keys: List[str]) -> Dict[str, float]:
+    # Cascade complète; la forme qui répond est mémorisée dans les capacités
+    # 1) Tentatives via markets(...)
+    for selection in MARKET_RATE_SELECTIONS:
+        apys = _apys_via_markets(selection, keys)
+        if apys:
+            _cap_set("borrow_apy_query", {"mode": "markets", "selection": selection})
+            return apys
+
+    # 2) Introspection pour savoir quels champs existent réellement
+    try:
+        selection = _introspected_selection(_introspected_fields())
+        if selection:
+            apys = _apys_via_markets(selection, keys)
+            if apys:
+                _cap_set("borrow_apy_query", {"mode": "markets", "selection": selection})
+                return apys
+    except _TRANSIENT_ERRORS:
+        raise
+    except Exception:
+        pass
+
+    # 3) Fallback final: marketByUniqueKey
+    apys = _apys_via_unique_key(keys)
+    if apys is None:
+        return {}
+    _cap_set("borrow_apy_query", {"mode": "by_key"})
+    return apys
+
 # -----------------------------------------------------------------------------
-# UI
+# Snapshots last-known-good (servis, marqués stale, quand le budget de rendu est dépassé)
 # -----------------------------------------------------------------------------
-st.set_page_config(page_title="DeFi Multi-Wallet Monitor", layout="wide")
-st.title("🧭 DeFi Multi-Wallet Monitor — Multi-wallet (Consolidated + Detail)")
+@st.cache_resource
+def _snapshot_store() -> Dict[str, Any]:
+    # books: taille max du book vu par sélection de chaînes; la borne des positions les couvre tous
+    return {"lock": threading.Lock(), "positions": OrderedDict(), "apys": OrderedDict(), "books": {}}
+
+def _snapshot_put(entries: "OrderedDict[str, Any]", key: str, value: Any, max_size: int) -> None:
+    entries[key] = value
+    entries.move_to_end(key)
+    while len(entries) > max_size:
+        entries.popitem(last=False)
+
+def _snapshot_get(entries: "OrderedDict[str, Any]", key: str) -> Optional[Tuple[float, Any]]:
+    # Entrée trop vieille: supprimée plutôt que servie
+    hit = entries.get(key)
+    if hit is None:
+        return None
+    if time.time() - hit[0] > SNAPSHOT_TTL:
+        del entries[key]
+        return None
+    entries.move_to_end(key)
+    return hit
+
+def _snapshot_key(address: str, chain_ids: Optional[List[int]]) -> str:
+    return f"{address.lower()}|{','.join(str(int(c)) for c in sorted(set(chain_ids or [])))}"
+
+def snapshot_reserve(n_wallets: int, chain_ids: Optional[List[int]]) -> None:
+    # Un book de n wallets garde un snapshot pour chacun (SNAPSHOT_MAX_WALLETS en plus pour le reste)
+    store = _snapshot_store()
+    chains = _snapshot_key("", chain_ids)
+    with store["lock"]:
+        store["books"][chains] = max(store["books"].get(chains, 0), int(n_wallets))
+
+def snapshot_positions_put(address: str, chain_ids: Optional[List[int]], items: List[Dict[str, Any]]) -> None:
+    store = _snapshot_store()
+    with store["lock"]:
+        max_size = SNAPSHOT_MAX_WALLETS + sum(store["books"].values())
+        _snapshot_put(store["positions"], _snapshot_key(address, chain_ids), (time.time(), items), max_size)
+
+def snapshot_positions_get(address: str, chain_ids: Optional[List[int]]) -> Optional[Tuple[float, List[Dict[str, Any]]]]:
+    store = _snapshot_store()
+    with store["lock"]:
+        return _snapshot_get(store["positions"], _snapshot_key(address, chain_ids))
+
+def snapshot_apys_put(apys: Dict[str, float]) -> None:
+    store = _snapshot_store()
+    now = time.time()
+    with store["lock"]:
+        for k, v in apys.items():
+            _snapshot_put(store["apys"], k, (now, v), SNAPSHOT_MAX_MARKETS)
+
+def snapshot_apys_get(keys: List[str]) -> Dict[str, Tuple[float, float]]:
+    # uniqueKey -> (ts du snapshot, APY)
+    store = _snapshot_store()
+    with store["lock"]:
+        hits = {k: _snapshot_get(store["apys"], k) for k in keys}
+    return {k: hit for k, hit in hits.items() if hit is not None}
+
+def borrow_apys_from_positions(markets: Dict[str, Dict[str, Any]]) -> Tuple[Dict[str, float], set]:
+    # Taux embarqués dans market{...} (mode combiné), lus depuis l'index des marchés → (apy_map, marchés couverts)
+    rated = {k: meta["market"] for k, meta in markets.items()
+             if k and any(f in meta["market"] for f in ("rates", "apy", "state"))}
+    return _extract_borrow_apys(list(rated.values())), set(rated)
+
+def _fetch_borrow_apys(keys: List[str]) -> Dict[str, float]:
+    # Forme de requête déjà connue: un seul aller-retour
+    known = _cap_get("borrow_apy_query")
+    if known is not None:
+        if known.get("mode") == "markets":
+            apys = _apys_via_markets(known["selection"], keys)
+        else:
+            apys = _apys_via_unique_key(keys)
+        if apys is not None:
+            return apys
+        # La forme mémorisée ne marche plus → redécouverte
+        _cap_drop("borrow_apy_query")
+        _cap_drop("schema_fields")
 
-with st.sidebar:
-    st.header("⚙️ Settings")
-    default_wallets_value = "\n".join(DEFAULT_WALLETS)
-    wallets_text = st.text_area("Wallets (one per line)", value=default_wallets_value, height=140)
-    wallets = re.findall(r"0x[a-fA-F0-9]{40}", wallets_text)
+    return _discover_borrow_apys(keys)
 
-    morpho_chain_sel = st.multiselect("Morpho chains", options=CHAIN_OPTIONS, default=[1])
-    recompute_usd = st.checkbox("Recompute USD via DefiLlama", value=True)
-    include_untrusted = st.checkbox("Show non-whitelisted markets", value=False)
+@st.cache_resource
+def _rate_cache() -> Dict[str, Any]:
+    # uniqueKey -> (ts, borrow APY ou None): un marché ajouté n'invalide pas les autres
+    return {"lock": threading.Lock(), "entries": {}}
 
-    st.markdown("—")
-    st.write("Timezone:", TIMEZONE)
+def morpho_market_borrow_apys(unique_keys: List[str]) -> Dict[str, float]:
+    keys = sorted(set(k for k in unique_keys if k))
+    if not keys:
+        return {}
+    cache = _rate_cache()
+    now = time.time()
+    refresh = _cache_refresh.get()
+    out: Dict[str, float] = {}
+    missing: List[str] = []
+    ages: List[float] = []
+    with cache["lock"]:
+        for k in keys:
+            hit = cache["entries"].get(k)
+            if refresh or hit is None or now - hit[0] > RATE_TTL:
+                missing.append(k)
+                continue
+            ages.append(now - hit[0])
+            if hit[1] is not None:
+                out[k] = hit[1]
+    _cache_note("borrow_apys", hits=len(ages), misses=len(missing), ages=ages)
+    if not missing:
+        return out
 
-# KPIs
-col1, col2, col3 = st.columns(3)
-col1.metric("Wallets", len(wallets))
-now_str = datetime.now(tz.gettz(TIMEZONE)).strftime("%Y-%m-%d %H:%M")
-col2.metric("Now", now_str)
-col3.metric("Chains", ", ".join(map(str, morpho_chain_sel)) if morpho_chain_sel else "all")
+    # Seuls les marchés absents/expirés partent sur le réseau
+    fetched = _fetch_borrow_apys(missing)
+    with cache["lock"]:
+        entries = cache["entries"]
+        expired = [k for k, (ts, _) in entries.items() if now - ts > RATE_TTL]
+        for k in expired:
+            del entries[k]
+        for k in missing:
+            entries[k] = (now, fetched.get(k))
+        n_entries = len(entries)
+        n_bytes = sum(len(k) + 16 for k in entries)
+    _cache_note("borrow_apys", evictions=len(expired), entries=n_entries, bytes_stored=n_bytes)
+    out.update({k: fetched[k] for k in missing if k in fetched})
+    return out
 
-st.divider()
+# -----------------------------------------------------------------------------
+# Index des marchés: uniqueKey → métadonnées (une construction par fetch)
+# -----------------------------------------------------------------------------
+def market_index(items: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    # Chaîne, adresses, décimales, symboles, clés prix/registre et whitelist, une fois par marché
+    index: Dict[str, Dict[str, Any]] = {}
+    for it in items:
+        m = it.get("market") or {}
+        mk = m.get("uniqueKey") or ""
+        if mk in index:
+            continue
+        cid = parse_chain_from_market_key(mk)
+        slug = CHAIN_SLUG.get(cid)
+        loan = (m.get("loanAsset") or {})
+        coll = (m.get("collateralAsset") or {})
+        la = (loan.get("address") or "").lower()
+        ca = (coll.get("address") or "").lower()
+        index[mk] = {
+            "chain": cid,
+            "whitelisted": m.get("whitelisted"),
+            "loan": loan.get("symbol"),
+            "collateralAsset": coll.get("symbol"),
+            "loanAddr": la,
+            "collAddr": ca,
+            "loanDec": int(loan.get("decimals") or 18),
+            "collDec": int(coll.get("decimals") or 18),
+            "loanToken": token_key(cid, la),
+            "collToken": token_key(cid, ca),
+            "loanPrice": f"{slug}:{la}" if slug and la else None,
+            "collPrice": f"{slug}:{ca}" if slug and ca else None,
+            "market": m,
+        }
+    return index
 
-# Récupération positions (tous wallets) + clés prix si recompute
-all_rows: List[Dict[str, Any]] = []
-debug_msgs: List[str] = []
-price_keys: List[str] = []
-wallet_items_map: Dict[str, List[Dict[str, Any]]] = {}
+def wallets_market_index(wallet_items_map: Dict[str, List[Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    return market_index(it for items in wallet_items_map.values() for it in items)
 
-for addr in wallets:
-    try:
-        items = morpho_user_positions(addr, morpho_chain_sel)
-        wallet_items_map[addr] = items
-        if recompute_usd:
-            for it in items:
-                m = it.get("market") or {}
-                mk = m.get("uniqueKey") or ""
-                cid = parse_chain_from_market_key(mk)
-                loan = (m.get("loanAsset") or {})
-                coll = (m.get("collateralAsset") or {})
-                la = (loan.get("address") or "").lower()
-                ca = (coll.get("address") or "").lower()
-                if cid in CHAIN_SLUG and la:
-                    price_keys.append(f"{CHAIN_SLUG[cid]}:{la}")
-                if cid in CHAIN_SLUG and ca:
-                    price_keys.append(f"{CHAIN_SLUG[cid]}:{ca}")
-    except Exception as e:
-        debug_msgs.append(f"{addr}: Morpho query failed → {e}")
-        wallet_items_map[addr] = []
-
-prices = _fetch_prices(price_keys) if recompute_usd else {}
+def market_price_keys(index: Dict[str, Dict[str, Any]]) -> List[str]:
+    return [k for meta in index.values() for k in (meta["loanPrice"], meta["collPrice"]) if k]
 
-# Construction des lignes unifiées (Supply = Collateral)
-for addr in wallets:
-    items = wallet_items_map.get(addr, [])
+def market_token_keys(index: Dict[str, Dict[str, Any]]) -> List[str]:
+    return [k for meta in index.values() for k in (meta["loanToken"], meta["collToken"]) if k]
+
+def apply_token_decimals(index: Dict[str, Dict[str, Any]], tokens: Dict[str, Dict[str, Any]]) -> None:
+    # Décimales du registre à la place de celles embarquées dans le marché
+    for meta in index.values():
+        for side in ("loan", "coll"):
+            t = tokens.get(meta[f"{side}Token"] or "")
+            if t is not None:
+                meta[f"{side}Dec"] = int(t["decimals"])
+
+# -----------------------------------------------------------------------------
+# Lignes unifiées (Supply = Collateral)
+# -----------------------------------------------------------------------------
+def build_wallet_rows(addr: str, items: List[Dict[str, Any]], markets: Dict[str, Dict[str, Any]],
+                      prices: Dict[str, Any], recompute_usd: bool, include_untrusted: bool,
+                      debug_msgs: List[str]) -> List[Dict[str, Any]]:
+    rows: List[Dict[str, Any]] = []
     for it in items:
         m = it.get("market") or {}
         stt = it.get("state") or {}
-        if (not include_untrusted) and m.get("whitelisted") is False:
+        mk = m.get("uniqueKey") or ""
+        meta = markets.get(mk) or market_index([it])[mk]
+        if (not include_untrusted) and meta["whitelisted"] is False:
             continue
 
-        mk = m.get("uniqueKey") or ""
-        cid = parse_chain_from_market_key(mk)
-        loan = (m.get("loanAsset") or {})
-        coll = (m.get("collateralAsset") or {})
-        loan_dec = int(loan.get("decimals") or 18)
-        coll_dec = int(coll.get("decimals") or 18)
-        loan_addr = (loan.get("address") or "").lower()
-        coll_addr = (coll.get("address") or "").lower()
-
-        s_raw = _to_dec(stt.get("supplyAssets"))
-        b_raw = _to_dec(stt.get("borrowAssets"))
-        c_raw = _to_dec(stt.get("collateral"))
-        s = _norm(s_raw, loan_dec)
-        b = _norm(b_raw, loan_dec)
-        c = _norm(c_raw, coll_dec)
+        # Montants API en base units: / 10**decimals, toujours
+        s = _to_amount(stt.get("supplyAssets")).shift(meta["loanDec"])
+        b = _to_amount(stt.get("borrowAssets")).shift(meta["loanDec"])
+        c = _to_amount(stt.get("collateral")).shift(meta["collDec"])
 
         # USD (recompute si possible, sinon API)
         if recompute_usd:
-            p_loan = _price_from_llama(prices, cid, loan_addr) or Decimal(0)
-            p_coll = _price_from_llama(prices, cid, coll_addr) or Decimal(0)
+            p_loan = _price_from_llama(prices, meta["loanPrice"]) or Amount()
+            p_coll = _price_from_llama(prices, meta["collPrice"]) or Amount()
             s_usd = s * p_loan
             b_usd = b * p_loan
             c_usd = c * p_coll
-            if p_loan == 0:
-                s_usd = _to_dec(stt.get("supplyAssetsUsd"))
-                b_usd = _to_dec(stt.get("borrowAssetsUsd"))
-            if p_coll == 0:
-                c_usd = _to_dec(stt.get("collateralUsd"))
+            if not p_loan:
+                s_usd = _to_amount(stt.get("supplyAssetsUsd"))
+                b_usd = _to_amount(stt.get("borrowAssetsUsd"))
+            if not p_coll:
+                c_usd = _to_amount(stt.get("collateralUsd"))
         else:
-            s_usd = _to_dec(stt.get("supplyAssetsUsd"))
-            b_usd = _to_dec(stt.get("borrowAssetsUsd"))
-            c_usd = _to_dec(stt.get("collateralUsd"))
+            s_usd = _to_amount(stt.get("supplyAssetsUsd"))
+            b_usd = _to_amount(stt.get("borrowAssetsUsd"))
+            c_usd = _to_amount(stt.get("collateralUsd"))
 
-        if max(s_usd, b_usd, c_usd) > Decimal(1e11):
+        if s_usd.exceeds(10 ** 11) or b_usd.exceeds(10 ** 11) or c_usd.exceeds(10 ** 11):
             debug_msgs.append(f"{addr} / {mk}: abnormal USD → skipped")
             continue
 
@@ -445,117 +1618,514 @@ for addr in wallets:
         supply_amt = c
         supply_usd = c_usd
 
-        row = {
+        rows.append({
             "wallet": addr,
             "marketKey": mk,
-            "loan": loan.get("symbol"),
-            "collateralAsset": coll.get("symbol"),
+            "loan": meta["loan"],
+            "collateralAsset": meta["collateralAsset"],
             "borrowAssets": float(b),
             "borrowUsd": float(b_usd),
             "supplyAssets": float(supply_amt),
             "supplyUsd": float(supply_usd),
-            "whitelisted": m.get("whitelisted"),
-        }
-        all_rows.append(row)
+            "whitelisted": meta["whitelisted"],
+        })
+    return rows
+
+ROW_COLUMNS = ["wallet", "marketKey", "loan", "collateralAsset", "borrowAssets", "borrowUsd",
+               "supplyAssets", "supplyUsd", "whitelisted"]
+_FLAT_COLUMNS = ["wallet", "marketKey", "supplyRaw", "borrowRaw", "collRaw", "supplyUsdApi",
+                 "borrowUsdApi", "collUsdApi"]
+_MARKET_COLUMNS = ["whitelisted", "loan", "collateralAsset", "loanDec", "collDec", "loanPrice", "collPrice"]
+
+def _flatten_items(wallets: List[str], wallet_items_map: Dict[str, List[Dict[str, Any]]]) -> pd.DataFrame:
+    # Une passe Python sans arithmétique: seuls les champs propres à la position (le reste vient de l'index)
+    recs = []
+    for addr in wallets:
+        for it in wallet_items_map.get(addr) or []:
+            stt = it.get("state") or {}
+            recs.append((addr, (it.get("market") or {}).get("uniqueKey") or "",
+                         stt.get("supplyAssets"), stt.get("borrowAssets"), stt.get("collateral"),
+                         stt.get("supplyAssetsUsd"), stt.get("borrowAssetsUsd"), stt.get("collateralUsd")))
+    return pd.DataFrame.from_records(recs, columns=_FLAT_COLUMNS)
+
+def _num_col(col: pd.Series) -> np.ndarray:
+    # Équivalent colonne de _to_amount: None / invalide → 0 (astype = float() exact, pas le parseur rapide de to_numeric)
+    try:
+        return col.astype(float).fillna(0).to_numpy()
+    except (TypeError, ValueError):
+        return np.array([float(_to_amount(x)) for x in col.astype(object)], dtype=float)
+
+def _price_table(prices: Dict[str, Any]) -> Dict[str, float]:
+    table: Dict[str, float] = {}
+    for k, v in prices.items():
+        p = (v or {}).get("price")
+        try:
+            table[k] = float(_to_amount(p)) if p is not None else 0.0
+        except Exception:
+            table[k] = 0.0
+    return table
+
+def build_rows_frame(wallets: List[str], wallet_items_map: Dict[str, List[Dict[str, Any]]],
+                     markets: Dict[str, Dict[str, Any]], prices: Dict[str, Any], recompute_usd: bool,
+                     include_untrusted: bool, debug_msgs: List[str]) -> pd.DataFrame:
+    # Même sortie que build_wallet_rows sur tous les wallets, en opérations colonne (float64)
+    df = _flatten_items(wallets, wallet_items_map)
+    if df.empty:
+        return pd.DataFrame(columns=ROW_COLUMNS)
+
+    # Métadonnées par marché (index), jointes par position via un indexer entier
+    if not df["marketKey"].isin(list(markets)).all():
+        markets = {**wallets_market_index(wallet_items_map), **markets}
+    mdf = pd.DataFrame.from_dict(markets, orient="index", columns=_MARKET_COLUMNS)
+    pos = mdf.index.get_indexer(df["marketKey"])
+    if not include_untrusted:
+        keep = ~pd.Series(mdf["whitelisted"].to_numpy()[pos], dtype=object).eq(False).to_numpy()
+        df, pos = df[keep], pos[keep]
+        if df.empty:
+            return pd.DataFrame(columns=ROW_COLUMNS)
+    meta = {c: mdf[c].to_numpy()[pos] for c in _MARKET_COLUMNS}
+
+    # Base units / 10**decimals, en un seul passage par colonne
+    loan_scale = np.power(10.0, meta["loanDec"].astype(np.int64))
+    coll_scale = np.power(10.0, meta["collDec"].astype(np.int64))
+    s = _num_col(df["supplyRaw"]) / loan_scale
+    b = _num_col(df["borrowRaw"]) / loan_scale
+    c = _num_col(df["collRaw"]) / coll_scale
+
+    # USD (recompute si possible, sinon API)
+    s_usd = _num_col(df["supplyUsdApi"])
+    b_usd = _num_col(df["borrowUsdApi"])
+    c_usd = _num_col(df["collUsdApi"])
+    if recompute_usd:
+        # Prix absent / nul → 0 (comme `_price_from_llama(...) or 0`), résolu une fois par marché
+        table = _price_table(prices)
+        p_loan = mdf["loanPrice"].map(table).fillna(0.0).to_numpy(dtype=float)[pos]
+        p_coll = mdf["collPrice"].map(table).fillna(0.0).to_numpy(dtype=float)[pos]
+        s_usd = np.where(p_loan != 0, s * p_loan, s_usd)
+        b_usd = np.where(p_loan != 0, b * p_loan, b_usd)
+        c_usd = np.where(p_coll != 0, c * p_coll, c_usd)
+
+    bad = np.maximum(np.maximum(s_usd, b_usd), c_usd) > 1e11
+    for addr, mk in zip(df["wallet"].to_numpy()[bad], df["marketKey"].to_numpy()[bad]):
+        debug_msgs.append(f"{addr} / {mk}: abnormal USD → skipped")
+
+    # Supply = Collateral (affichage)
+    out = pd.DataFrame({
+        "wallet": df["wallet"].to_numpy(),
+        "marketKey": df["marketKey"].to_numpy(),
+        "loan": meta["loan"],
+        "collateralAsset": meta["collateralAsset"],
+        "borrowAssets": b,
+        "borrowUsd": b_usd,
+        "supplyAssets": c,
+        "supplyUsd": c_usd,
+        "whitelisted": meta["whitelisted"],
+    })
+    return out[~bad].reset_index(drop=True)
+
+# -----------------------------------------------------------------------------
+# Store colonne des positions (remplace la liste de dicts)
+# -----------------------------------------------------------------------------
+_STORE_CATEGORIES = ["wallet", "marketKey", "loan", "collateralAsset"]
+_STORE_FLOATS = ["borrowAssets", "borrowUsd", "supplyAssets", "supplyUsd"]
+
+def position_store(frame: pd.DataFrame) -> pd.DataFrame:
+    # Catégories pour wallet/marché/symboles (chaque chaîne distincte stockée une fois), float64,
+    # whitelist booléen nullable; lignes regroupées par wallet (ordre d'arrivée) pour un découpage par tranches.
+    # Marchés/symboles: catégories triées, les groupby gardent l'ordre lexical d'avant.
+    cols: Dict[str, Any] = {}
+    for c in _STORE_CATEGORIES:
+        values = frame[c].to_numpy(dtype=object) if c in frame else np.array([], dtype=object)
+        if c == "wallet":
+            cols[c] = pd.Categorical(values, categories=pd.unique(values[pd.notna(values)]))
+        else:
+            cols[c] = pd.Categorical(values)
+    for c in _STORE_FLOATS:
+        cols[c] = frame[c].to_numpy(dtype=float) if c in frame else np.array([], dtype=float)
+    wl = frame["whitelisted"] if "whitelisted" in frame else pd.Series([], dtype=object)
+    cols["whitelisted"] = pd.array(wl.to_numpy(dtype=object), dtype="boolean")
+    store = pd.DataFrame(cols)[ROW_COLUMNS]
+    codes = store["wallet"].cat.codes.to_numpy()
+    if len(codes) and (np.diff(codes) < 0).any():
+        store = store.iloc[np.argsort(codes, kind="stable")].reset_index(drop=True)
+    return store
+
+def wallet_slices(store: pd.DataFrame) -> Dict[str, slice]:
+    # wallet → tranche de lignes contiguës (store regroupé par wallet): iloc[tranche] sans copie
+    codes = store["wallet"].cat.codes.to_numpy()
+    n = len(store["wallet"].cat.categories)
+    starts = np.searchsorted(codes, np.arange(n), side="left")
+    ends = np.searchsorted(codes, np.arange(n), side="right")
+    return {w: slice(int(a), int(b)) for w, a, b in zip(store["wallet"].cat.categories, starts, ends)}
+
+# -----------------------------------------------------------------------------
+# Métriques vectorisées (LTV, taux, totaux) et format d'affichage partagé
+# -----------------------------------------------------------------------------
+# Taux affichés en % via column_config (valeur numérique, pas de chaîne par ligne)
+RATE_COLUMN_CONFIG = {"borrowRate": st.column_config.NumberColumn("borrowRate", format="%.2f%%")}
+
+def rate_pct(raw: pd.Series) -> pd.Series:
+    # Fraction (≤ 1.5) → ×100, sinon déjà en %; NaN conservé
+    return raw.where(raw > 1.5, raw * 100)
+
+def ltv(borrow_usd: Any, supply_usd: Any) -> np.ndarray:
+    # borrow / supply, NaN si supply ≤ 0
+    bor = np.asarray(borrow_usd, dtype=float)
+    sup = np.asarray(supply_usd, dtype=float)
+    return np.divide(bor, sup, out=np.full(len(sup), np.nan), where=np.nan_to_num(sup) > 0)
+
+def usd_totals(frame: pd.DataFrame) -> Tuple[float, float]:
+    # (supply USD, borrow USD), NaN comptés 0
+    return float(frame["supplyUsd"].fillna(0).sum()), float(frame["borrowUsd"].fillna(0).sum())
+
+def show_totals(supply_usd: float, borrow_usd: float, slots: Optional[List[Any]] = None) -> None:
+    # Supply / Borrow / Net, sur st ou sur trois conteneurs (colonnes)
+    m1, m2, m3 = slots or (st, st, st)
+    m1.metric("Supply USD (collateral)", f"{supply_usd:,.2f}")
+    m2.metric("Borrow USD", f"{borrow_usd:,.2f}")
+    m3.metric("Net (Collateral − Borrow)", f"{(supply_usd - borrow_usd):,.2f}")
+
+def wallet_view(store: pd.DataFrame, apy_map: Dict[str, float]) -> Dict[str, Any]:
+    # Vue par wallet en une passe: taux et LTV par ligne, tranches, totaux par wallet
+    # (toutes les lignes / emprunts actifs, pour les deux états du filtre borrow > 0)
+    frame = store.copy(deep=False)
+    frame["borrowRateRaw"] = frame["marketKey"].map(apy_map).astype(float)
+    frame["borrowRate"] = rate_pct(frame["borrowRateRaw"])
+    frame["ltv"] = ltv(frame["borrowUsd"], frame["supplyUsd"])
+    sup = frame["supplyUsd"].fillna(0).to_numpy()
+    bor = frame["borrowUsd"].fillna(0).to_numpy()
+
+    codes = frame["wallet"].cat.codes.to_numpy()
+    n = len(frame["wallet"].cat.categories)
+    active = bor > 0
+    totals = pd.DataFrame({
+        "supplyUsd": np.bincount(codes, weights=sup, minlength=n),
+        "borrowUsd": np.bincount(codes, weights=bor, minlength=n),
+        "supplyUsdActive": np.bincount(codes, weights=np.where(active, sup, 0.0), minlength=n),
+        "borrowUsdActive": np.bincount(codes, weights=np.where(active, bor, 0.0), minlength=n),
+        "activeRows": np.bincount(codes, weights=active, minlength=n).astype(int),
+    }, index=frame["wallet"].cat.categories)
+    return {"frame": frame, "slices": wallet_slices(frame), "totals": totals}
+
+# -----------------------------------------------------------------------------
+# Pré-chauffage en arrière-plan (DEFAULT_WALLETS + watchlists) avant expiration des TTL
+# -----------------------------------------------------------------------------
+@st.cache_resource
+def _prewarm_status() -> Dict[str, Any]:
+    return {"runs": 0, "last_run": None, "duration_s": None, "wallets": 0, "markets": 0, "error": None}
+
+def prewarm_once(wallets: List[str], chain_ids: Optional[List[int]], markets: List[str]) -> Dict[str, Any]:
+    # Re-fetch forcé positions → prix → taux; les pages interactives retrouvent des caches chauds
+    token = _cache_refresh.set(True)
+    try:
+        items_map: Dict[str, List[Dict[str, Any]]] = {}
+        snapshot_reserve(len(set(wallets)), chain_ids)
+        for addr, res in morpho_positions_for_wallets(wallets, chain_ids).items():
+            if not isinstance(res, Exception):
+                items_map[addr] = res
+                snapshot_positions_put(addr, chain_ids, res)
+        index = wallets_market_index(items_map)
+        keys = sorted(set(market_price_keys(index)))
+        if keys:
+            _refresh_prices_bg(keys)
+        # Registre: seuls les tokens encore inconnus partent sur le réseau
+        token_registry(market_token_keys(index))
+        mks = set(markets)
+        mks.update(index)
+        apys = morpho_market_borrow_apys([k for k in mks if k])
+        snapshot_apys_put(apys)
+        return {"wallets": len(items_map), "markets": len(mks)}
+    finally:
+        _cache_refresh.reset(token)
+
+class _BackgroundCtxFilter(logging.Filter):
+    # Pas de ScriptRunContext attendu hors session: l'avertissement de Streamlit n'est que du bruit
+    def filter(self, record: logging.LogRecord) -> bool:
+        return not _background.get()
+
+def _prewarm_loop() -> None:
+    _background.set(True)
+    status = _prewarm_status()
+    wallets = list(dict.fromkeys(DEFAULT_WALLETS + WATCHLIST_WALLETS))
+    while True:
+        t0 = time.monotonic()
+        try:
+            status.update(prewarm_once(wallets, PREWARM_CHAINS, WATCHLIST_MARKETS), error=None)
+        except Exception as e:
+            status["error"] = str(e)
+        status.update(runs=status["runs"] + 1, last_run=time.time(), duration_s=round(time.monotonic() - t0, 2))
+        time.sleep(PREWARM_INTERVAL)
+
+@st.cache_resource
+def _start_prewarmer() -> threading.Thread:
+    # Un seul thread daemon par process, quel que soit le nombre de sessions
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").addFilter(_BackgroundCtxFilter())
+    t = threading.Thread(target=_prewarm_loop, name="cache-prewarmer", daemon=True)
+    t.start()
+    return t
+
+# -----------------------------------------------------------------------------
+# UI
+# -----------------------------------------------------------------------------
+st.set_page_config(page_title="DeFi Multi-Wallet Monitor", layout="wide")
+if PREWARM_ENABLED:
+    _start_prewarmer()
+st.title("🧭 DeFi Multi-Wallet Monitor — Multi-wallet (Consolidated + Detail)")
+
+with st.sidebar:
+    st.header("⚙️ Settings")
+    default_wallets_value = "\n".join(DEFAULT_WALLETS)
+    wallets_text = st.text_area("Wallets (one per line)", value=default_wallets_value, height=140)
+    wallets = re.findall(r"0x[a-fA-F0-9]{40}", wallets_text)
+
+    morpho_chain_sel = st.multiselect("Morpho chains", options=CHAIN_OPTIONS, default=[1])
+    recompute_usd = st.checkbox("Recompute USD via DefiLlama", value=True)
+    include_untrusted = st.checkbox("Show non-whitelisted markets", value=False)
+    progressive = st.checkbox("Progressive rendering", value=PROGRESSIVE_RENDER,
+                              help="Show wallet rows and totals as each wallet's fetch completes.")
+
+    st.markdown("—")
+    st.write("Timezone:", TIMEZONE)
 
-# Borrow APY par marché
+# KPIs
+col1, col2, col3 = st.columns(3)
+col1.metric("Wallets", len(wallets))
+now_str = datetime.now(tz.gettz(TIMEZONE)).strftime("%Y-%m-%d %H:%M")
+col2.metric("Now", now_str)
+col3.metric("Chains", ", ".join(map(str, morpho_chain_sel)) if morpho_chain_sel else "all")
+
+st.divider()
+
+# Récupération positions (tous wallets) + clés prix si recompute
+debug_msgs: List[str] = []
+wallet_items_map: Dict[str, List[Dict[str, Any]]] = {}
+stale_wallets: Dict[str, float] = {}  # wallet -> ts du snapshot servi
+stale_apys: Dict[str, float] = {}  # marché -> ts du taux servi depuis le snapshot
+
+# Budget de rendu: tous les appels réseau ci-dessous s'arrêtent à l'échéance
+if RENDER_BUDGET_S > 0:
+    _render_deadline.set(time.monotonic() + RENDER_BUDGET_S)
+
+# Mode progressif: lignes + totaux provisoires dessinés au fil des wallets reçus
+live = st.empty() if progressive and wallets else None
+live_rows: Dict[str, List[Dict[str, Any]]] = {}
+live_state = {"drawn_at": 0.0}
+if live is not None:
+    with live.container():
+        live_status = st.empty()
+        live_metrics = st.empty()
+        live_table = st.empty()
+
+def _draw_live(force: bool = False) -> None:
+    if not force and time.monotonic() - live_state["drawn_at"] < LIVE_REDRAW_S:
+        return
+    live_state["drawn_at"] = time.monotonic()
+    rows = [r for rs in live_rows.values() for r in rs]
+    live_status.caption(f"⏳ Loading… {len(live_rows)}/{len(wallets)} wallets (provisional values)")
+    with live_metrics.container():
+        show_totals(sum(r["supplyUsd"] for r in rows), sum(r["borrowUsd"] for r in rows), st.columns(3))
+    if rows:
+        live_table.dataframe(
+            pd.DataFrame(rows)[["wallet","marketKey","loan","collateralAsset","borrowUsd","supplyUsd"]],
+            use_container_width=True,
+        )
+
+def _on_wallet(addr: str, res: Any) -> None:
+    # Prix: uniquement ceux déjà en cache (pas d'appel réseau pendant le streaming)
+    items = [] if isinstance(res, Exception) else res
+    index = market_index(items)
+    apply_token_decimals(index, token_registry(market_token_keys(index), fetch=False))
+    live_prices = peek_prices(market_price_keys(index)) if recompute_usd else {}
+    live_rows[addr] = build_wallet_rows(addr, items, index, live_prices, recompute_usd, include_untrusted, [])
+    _draw_live(force=len(live_rows) >= len(wallets))
+
+snapshot_reserve(len(set(wallets)), morpho_chain_sel)
+positions_by_wallet = morpho_positions_for_wallets(wallets, morpho_chain_sel,
+                                                   on_wallet=_on_wallet if live is not None else None)
+for addr in wallets:
+    items = positions_by_wallet.get(addr, [])
+    if isinstance(items, Exception):
+        snap = snapshot_positions_get(addr, morpho_chain_sel)
+        if snap is None:
+            debug_msgs.append(f"{addr}: Morpho query failed → {items}")
+            wallet_items_map[addr] = []
+            continue
+        stale_wallets[addr] = snap[0]
+        debug_msgs.append(f"{addr}: Morpho query failed → {items} (serving snapshot from {to_local(int(snap[0] * 1000))})")
+        items = snap[1]
+    else:
+        snapshot_positions_put(addr, morpho_chain_sel, items)
+    wallet_items_map[addr] = items
+
+# Index des marchés (une fois par fetch), partagé par prix, lignes et APY;
+# décimales autoritatives depuis le registre persisté, complété en bloc via l'API
+markets = wallets_market_index(wallet_items_map)
 try:
-    mk_list = [r.get("marketKey") for r in all_rows if r.get("marketKey")]
-    apy_map = morpho_market_borrow_apys(mk_list) if mk_list else {}
-except Exception:
-    apy_map = {}
+    tokens = _within_deadline(token_registry, market_token_keys(markets))
+except Exception as e:
+    # Échéance / échec: décimales déjà connues, sinon celles embarquées dans les marchés
+    tokens = token_registry(market_token_keys(markets), fetch=False)
+    debug_msgs.append(f"Token registry lookup failed → {e} ({len(tokens)} tokens already known)")
+apply_token_decimals(markets, tokens)
+
+prices: Dict[str, Any] = {}
+if recompute_usd:
+    prices, price_errors = cached_prices(market_price_keys(markets))
+    debug_msgs.extend(price_errors)
+
+# Construction des lignes unifiées (Supply = Collateral)
+if ROW_BUILDER == "loop":
+    rows = [r for addr in wallets for r in build_wallet_rows(addr, wallet_items_map.get(addr, []), markets, prices,
+                                                             recompute_usd, include_untrusted, debug_msgs)]
+    positions = position_store(pd.DataFrame(rows, columns=ROW_COLUMNS))
+else:
+    positions = position_store(build_rows_frame(wallets, wallet_items_map, markets, prices, recompute_usd,
+                                                include_untrusted, debug_msgs))
+
+# Borrow APY par marché (déjà reçu avec les positions en mode combiné)
+apy_map, rated_keys = borrow_apys_from_positions(markets)
+# Taux embarqués présents uniquement dans des positions servies depuis un snapshot: stale aussi
+fresh_mks = {(it.get("market") or {}).get("uniqueKey") for addr, items in wallet_items_map.items()
+             if addr not in stale_wallets for it in items}
+for addr, ts in stale_wallets.items():
+    for it in wallet_items_map.get(addr, []):
+        mk = (it.get("market") or {}).get("uniqueKey")
+        if mk in rated_keys and mk not in fresh_mks:
+            stale_apys[mk] = min(stale_apys.get(mk, ts), ts)
+mk_list = [k for k, meta in markets.items()
+           if k and k not in rated_keys and (include_untrusted or meta["whitelisted"] is not False)]
+try:
+    if mk_list:
+        apy_map.update(_within_deadline(morpho_market_borrow_apys, mk_list))
+    snapshot_apys_put(apy_map)
+except Exception as e:
+    # Taux manquants servis depuis le dernier snapshot
+    snapshot_apys_put(apy_map)
+    for k, (ts, v) in snapshot_apys_get([k for k in mk_list if k not in apy_map]).items():
+        apy_map[k] = v
+        stale_apys[k] = ts
+    debug_msgs.append(f"Borrow APY lookup failed → {e} ({len(stale_apys)} rates from snapshot)")
+_render_deadline.set(None)
+if live is not None:
+    live.empty()
+
+if stale_wallets:
+    st.warning(
+        f"⏳ {len(stale_wallets)} wallet(s) served from the last successful snapshot "
+        f"(render budget of {RENDER_BUDGET_S:g}s exceeded or upstream failing): "
+        + ", ".join(f"{a[:8]}… ({to_local(int(ts * 1000))})" for a, ts in list(stale_wallets.items())[:10])
+        + (" …" if len(stale_wallets) > 10 else "")
+    )
+if stale_apys:
+    st.warning(
+        f"⏳ {len(stale_apys)} borrow rate(s) served from the last successful snapshot "
+        f"(oldest from {to_local(int(min(stale_apys.values()) * 1000))}), flagged in the rateStale column"
+    )
+# Colonne rateStale affichée seulement si des taux viennent du snapshot
+stale_cols = ["rateStale"] if stale_apys else []
 
 # ---------------- Vue consolidée ----------------
 tab_cons, tab_per = st.tabs(["📊 Consolidated", "🧩 Per-wallet detail"])
 
 with tab_cons:
     st.subheader("Consolidated view (all selected wallets)")
-    if not all_rows:
+    if positions.empty:
         st.info("No Morpho positions detected for selected wallets (or filtered out).")
     else:
-        df_all = pd.DataFrame(all_rows)
-        df_all["borrowRateRaw"] = df_all["marketKey"].map(apy_map)
-
-        def _fmt_rate(x):
-            if pd.isna(x): return None
-            x = float(x)
-            return f"{x*100:.2f}%" if x <= 1.5 else f"{x:.2f}%"
-
-        df_all["borrowRate"] = df_all["borrowRateRaw"].apply(_fmt_rate)
+        # Copie superficielle: colonnes ajoutées localement, données du store partagées
+        df_all = positions.copy(deep=False)
+        df_all["borrowRateRaw"] = df_all["marketKey"].map(apy_map).astype(float)
+        df_all["borrowRate"] = rate_pct(df_all["borrowRateRaw"])
+        df_all["rateStale"] = df_all["marketKey"].isin(list(stale_apys))
 
         only_borrow_cons = st.toggle("Borrow-only (consolidated)", value=True, key="boronly_cons")
-        df_show = df_all.copy()
+        df_show = df_all
         if only_borrow_cons:
             df_show = df_show[df_show["borrowUsd"].fillna(0) > 0]
 
         # Agrégat par marché (somme sur tous les wallets)
         agg_cols = {"borrowAssets": "sum", "borrowUsd": "sum", "supplyAssets": "sum", "supplyUsd": "sum"}
-        df_agg = df_show.groupby(["marketKey","loan","collateralAsset","whitelisted","borrowRate"], dropna=False).agg(agg_cols).reset_index()
+        df_agg = df_show.groupby(["marketKey","loan","collateralAsset","whitelisted","borrowRate"], dropna=False, observed=True).agg(agg_cols).reset_index()
 
         # LTV agrégée
-        df_agg["ltv"] = df_agg.apply(lambda r: (r["borrowUsd"]/r["supplyUsd"]) if r["supplyUsd"]>0 else None, axis=1)
-
-        total_supply_usd = float(df_agg["supplyUsd"].fillna(0).sum())
-        total_borrow_usd = float(df_agg["borrowUsd"].fillna(0).sum())
+        df_agg["ltv"] = ltv(df_agg["borrowUsd"], df_agg["supplyUsd"])
+        df_agg["rateStale"] = df_agg["marketKey"].isin(list(stale_apys))
 
         left, right = st.columns([2,1])
         with left:
-            show_cols = ["marketKey","loan","collateralAsset","borrowUsd","supplyUsd","borrowRate","ltv","whitelisted"]
-            st.dataframe(df_agg[show_cols], use_container_width=True)
+            show_cols = ["marketKey","loan","collateralAsset","borrowUsd","supplyUsd","borrowRate"] + stale_cols + ["ltv","whitelisted"]
+            st.dataframe(df_agg[show_cols], use_container_width=True, column_config=RATE_COLUMN_CONFIG)
         with right:
-            st.metric("Supply USD (collateral)", f"{total_supply_usd:,.2f}")
-            st.metric("Borrow USD", f"{total_borrow_usd:,.2f}")
-            st.metric("Net (Collateral − Borrow)", f"{(total_supply_usd - total_borrow_usd):,.2f}")
+            show_totals(*usd_totals(df_agg))
 
         with st.expander("Underlying rows (by wallet)"):
             st.dataframe(
-                df_show[["wallet","marketKey","loan","collateralAsset","borrowUsd","supplyUsd","borrowRate","whitelisted"]],
-                use_container_width=True
+                df_show[["wallet","marketKey","loan","collateralAsset","borrowUsd","supplyUsd","borrowRate"] + stale_cols + ["whitelisted"]],
+                use_container_width=True, column_config=RATE_COLUMN_CONFIG
             )
 
         # Debug facultatif pour le borrow rate
         if st.checkbox("🔎 Debug borrow rate map (consolidated)", value=False):
-            st.write("Nb markets:", len({r.get("marketKey") for r in all_rows}))
+            st.write("Nb markets:", positions["marketKey"].nunique())
             st.write("Nb with rate:", len([k for k,v in (apy_map or {}).items() if v is not None]))
             st.json(dict(list((apy_map or {}).items())[:10]))
 
 # ---------------- Vue par wallet ----------------
 with tab_per:
-    if not all_rows:
+    if positions.empty:
         st.info("No Morpho positions for the selected wallets.")
     else:
-        for addr in wallets:
+        view = wallet_view(positions, apy_map)
+        view["frame"]["rateStale"] = view["frame"]["marketKey"].isin(list(stale_apys))
+
+        # Recherche + sélection + pagination: seuls les wallets de la page courante sont rendus
+        all_wallets = list(dict.fromkeys(wallets))
+        c_search, c_pick, c_size, c_page = st.columns([3, 3, 1, 1])
+        query = c_search.text_input("Search wallets", placeholder="0x… (substring)", key="wallet_search")
+        query = query.strip().lower()
+        matches = [a for a in all_wallets if query in a.lower()] if query else all_wallets
+        picked = c_pick.selectbox("Wallet", ["All matching wallets"] + matches)
+        page_sizes = sorted({WALLETS_PER_PAGE, 10, 25, 50, 100})
+        page_size = c_size.selectbox("Per page", page_sizes, index=page_sizes.index(WALLETS_PER_PAGE),
+                                     key="wallets_per_page")
+        if picked in matches:
+            visible = [picked]
+        else:
+            n_pages = max(1, -(-len(matches) // page_size))
+            page = int(c_page.number_input(f"Page (of {n_pages})", min_value=1, max_value=n_pages, value=1, step=1))
+            visible = matches[(page - 1) * page_size: page * page_size]
+        if not matches:
+            st.info("No wallet matches this search.")
+        elif len(visible) < len(matches):
+            first = matches.index(visible[0]) + 1
+            st.caption(f"Showing {first}–{first + len(visible) - 1} of {len(matches)} wallet(s)")
+
+        for addr in visible:
             st.markdown(f"### 👛 {addr}")
-            df_w = pd.DataFrame([r for r in all_rows if r["wallet"] == addr])
+            if addr in stale_wallets:
+                st.caption(f"⏳ Stale: last successful snapshot from {to_local(int(stale_wallets[addr] * 1000))}")
+            df_w = view["frame"].iloc[view["slices"].get(addr, slice(0, 0))]
             if df_w.empty:
                 st.info("No positions for this wallet.")
                 continue
 
-            df_w["borrowRateRaw"] = df_w["marketKey"].map(apy_map)
-
-            def _fmt_rate(x):
-                if pd.isna(x): return None
-                x = float(x)
-                return f"{x*100:.2f}%" if x <= 1.5 else f"{x:.2f}%"
-
-            df_w["borrowRate"] = df_w["borrowRateRaw"].apply(_fmt_rate)
-
             only_borrow = st.toggle("Afficher uniquement les emprunts actifs (borrow > 0)", value=True, key=f"boronly_{addr}")
-            df_show = df_w[df_w["borrowUsd"].fillna(0) > 0] if only_borrow else df_w.copy()
-
-            df_show["ltv"] = df_show.apply(lambda r: (r["borrowUsd"]/r["supplyUsd"]) if r["supplyUsd"]>0 else None, axis=1)
-
-            total_supply_usd = float(df_show["supplyUsd"].fillna(0).sum())
-            total_borrow_usd = float(df_show["borrowUsd"].fillna(0).sum())
+            tot = view["totals"].loc[addr]
+            if only_borrow:
+                df_show = df_w[df_w["borrowUsd"].fillna(0) > 0] if tot["activeRows"] < len(df_w) else df_w
+                total_supply_usd = float(tot["supplyUsdActive"])
+                total_borrow_usd = float(tot["borrowUsdActive"])
+            else:
+                df_show = df_w
+                total_supply_usd = float(tot["supplyUsd"])
+                total_borrow_usd = float(tot["borrowUsd"])
 
             left, right = st.columns([2,1])
             with left:
-                cols = ["marketKey","loan","collateralAsset","borrowAssets","borrowUsd","supplyAssets","supplyUsd","borrowRate","ltv","whitelisted"]
-                st.dataframe(df_show[cols], use_container_width=True)
+                cols = ["marketKey","loan","collateralAsset","borrowAssets","borrowUsd","supplyAssets","supplyUsd","borrowRate"] + stale_cols + ["ltv","whitelisted"]
+                st.dataframe(df_show[cols], use_container_width=True, column_config=RATE_COLUMN_CONFIG)
             with right:
-                st.metric("Supply USD (collateral)", f"{total_supply_usd:,.2f}")
-                st.metric("Borrow USD", f"{total_borrow_usd:,.2f}")
-                st.metric("Net (Collateral − Borrow)", f"{(total_supply_usd - total_borrow_usd):,.2f}")
+                show_totals(total_supply_usd, total_borrow_usd)
 
             # Debug facultatif par wallet
             if st.checkbox(f"🔎 Debug borrow rate map ({addr[:6]}…)", value=False, key=f"dbg_{addr}"):
@@ -565,6 +2135,16 @@ with tab_per:
 
             st.markdown("---")
 
+# Diagnostics (débit et concurrence vers l'API Morpho)
+with st.expander("Diagnostics"):
+    st.caption("Morpho API limiter (token bucket + AIMD concurrency)")
+    st.json({**morpho_throughput_metrics(), "circuit": morpho_breaker_state()})
+    st.caption("Caches (hits / misses / size / evictions / age at hit)")
+    st.dataframe(pd.DataFrame.from_dict(cache_stats(), orient="index"), use_container_width=True)
+    if PREWARM_ENABLED:
+        st.caption(f"Background pre-warmer (every {PREWARM_INTERVAL:g}s)")
+        st.json(_prewarm_status())
+
 # Debug log global
 if debug_msgs:
     with st.expander("Debug log"):